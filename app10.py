@@ -1,10 +1,32 @@
-from flask import Flask, request, send_file
+from flask import Flask, request, send_file, Response, make_response, redirect
+from werkzeug.datastructures import MIMEAccept, ResponseCacheControl
+from werkzeug.http import parse_accept_header, parse_cache_control_header, parse_date, parse_etags, quote_etag
 from io import BytesIO
 from PIL import Image
+from collections import OrderedDict, namedtuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import parse_url
+from urllib3.util.retry import Retry
+from urllib3.exceptions import LocationParseError
 import re
+from urllib.parse import urlsplit
 import configparser
 import threading
+import hashlib
+import os
+import tempfile
+import sqlite3
+import time
+import bisect
+import itertools
+import math
+import json
+import uuid
+from datetime import datetime, timezone
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 
@@ -13,170 +35,2112 @@ config = configparser.ConfigParser()
 config.read('config.ini')
 allowed_domains = {domain.strip() for domain in config.get('app', 'allowed_domains').split(',')}
 
+# Read how often config.ini is checked for changes; allowed_domains is reloaded without a restart
+config_reload_interval = config.getfloat('app', 'reload_interval', fallback=2.0)
+
+# Read derivative cache limits from config file
+cache_memory_bytes = config.getint('cache', 'memory_bytes', fallback=64 * 1024 * 1024)
+cache_disk_dir = config.get('cache', 'disk_dir', fallback='cache')
+cache_disk_bytes = config.getint('cache', 'disk_bytes', fallback=1024 * 1024 * 1024)
+# 'files' keeps one file per derivative in disk_dir; 'sqlite' keeps all of them in one database
+# file shared by every worker process on the host, with a size limit that covers all of them
+cache_backend = config.get('cache', 'backend', fallback='files')
+cache_sqlite_path = config.get('cache', 'sqlite_path', fallback='cache.sqlite3')
+
+# Read how long a request waits for an identical in-flight transform
+coalesce_timeout = config.getfloat('coalesce', 'timeout', fallback=30.0)
+
+# Read origin connection pool, timeout and retry settings from config file
+origin_pool_connections = config.getint('origin', 'pool_connections', fallback=max(len(allowed_domains), 10))
+origin_pool_maxsize = config.getint('origin', 'pool_maxsize', fallback=20)
+origin_connect_timeout = config.getfloat('origin', 'connect_timeout', fallback=3.05)
+origin_read_timeout = config.getfloat('origin', 'read_timeout', fallback=10.0)
+origin_retries = config.getint('origin', 'retries', fallback=2)
+
+# Read origin download limits; larger bodies or pixel counts are rejected while downloading
+origin_max_bytes = config.getint('origin', 'max_bytes', fallback=50 * 1024 * 1024)
+origin_max_pixels = config.getint('origin', 'max_pixels', fallback=Image.MAX_IMAGE_PIXELS)
+origin_probe_bytes = config.getint('origin', 'probe_bytes', fallback=256 * 1024)
+origin_chunk_size = 64 * 1024
+
+# Passed-through bodies up to this size are kept in the origin store while they are streamed
+passthrough_cache_bytes = config.getint('origin', 'passthrough_cache_bytes', fallback=8 * 1024 * 1024)
+
+# Origin response headers forwarded with a streamed passthrough
+passthrough_headers = ('Content-Type', 'Content-Length', 'Content-Encoding', 'Vary', 'ETag', 'Last-Modified', 'Cache-Control', 'Expires')
+
+# Read the origin store size and the freshness lifetime used when the origin gives none
+origin_store_bytes = config.getint('origin_store', 'memory_bytes', fallback=256 * 1024 * 1024)
+origin_default_ttl = config.getint('origin_store', 'default_ttl', fallback=60)
+
+# Read how long origin 404/410 responses and failed renders of known origin images are remembered
+negative_ttl = config.getint('origin_store', 'negative_ttl', fallback=30)
+
+# Read the stale windows: for stale_while_revalidate seconds after an origin image expires its
+# derivatives are served right away while a background thread revalidates and re-renders them;
+# while the origin cannot be revalidated they are served for up to max_stale seconds after expiry
+stale_while_revalidate = config.getint('origin_store', 'stale_while_revalidate', fallback=300)
+max_stale = config.getint('origin_store', 'max_stale', fallback=86400)
+refresh_threads = config.getint('origin_store', 'refresh_threads', fallback=4)
+
+# Read the per-origin circuit breaker: after `failures` consecutive errors requests to that
+# origin fail fast for reset_timeout seconds, then a single probe request is let through
+breaker_failures = config.getint('breaker', 'failures', fallback=5)
+breaker_reset_timeout = config.getfloat('breaker', 'reset_timeout', fallback=30.0)
+
+# Read the Cache-Control header sent to clients with transformed images
+http_cache_control = config.get('http', 'cache_control', fallback='public, max-age=86400')
+
+# Read the size bucketing policy; requested sizes are rounded up to the next breakpoint
+# (or multiple of step) and either served directly or redirected to the bucketed URL
+bucket_breakpoints = sorted(int(size) for size in config.get('buckets', 'breakpoints', fallback='').split(',') if size.strip())
+bucket_step = config.getint('buckets', 'step', fallback=0)
+bucket_mode = config.get('buckets', 'mode', fallback='serve')
+
+# Read the batch endpoint limits: jobs per request, jobs running at once per batch,
+# and threads shared by all batches
+batch_max_jobs = config.getint('batch', 'max_jobs', fallback=100)
+batch_concurrency = config.getint('batch', 'concurrency', fallback=8)
+batch_threads = config.getint('batch', 'threads', fallback=32)
+
+# Read the decode memory budget: transforms are admitted while the estimated decoded size of
+# all running ones stays under memory_bytes, and wait up to wait seconds for room before a 503
+admission_memory_bytes = config.getint('admission', 'memory_bytes', fallback=1024 * 1024 * 1024)
+admission_wait = config.getfloat('admission', 'wait', fallback=10.0)
+admission_retry_after = config.getint('admission', 'retry_after', fallback=5)
+
+# Read the peer settings: nodes lists the base URL of every converter node and self_url is the
+# entry of this node. Each transform key is owned by one node through consistent hashing;
+# cache misses for keys owned by another node are rendered there, or here if it is unreachable.
+peer_nodes = [node.strip().rstrip('/') for node in config.get('peers', 'nodes', fallback='').split(',') if node.strip()]
+peer_self = config.get('peers', 'self_url', fallback='').strip().rstrip('/')
+peer_replicas = config.getint('peers', 'replicas', fallback=100)
+peer_connect_timeout = config.getfloat('peers', 'connect_timeout', fallback=1.0)
+peer_read_timeout = config.getfloat('peers', 'read_timeout', fallback=30.0)
+
+# Read the downscaling strategy; disable fast_downscale to compare against a full decode and single resample
+fast_downscale = config.getboolean('resize', 'fast_downscale', fallback=True)
+reducing_gap = config.getfloat('resize', 'reducing_gap', fallback=2.0)
+
+# Read the worker process pool settings; processes = 0 runs transforms in the request thread
+worker_processes = config.getint('workers', 'processes', fallback=os.cpu_count() or 1)
+worker_queue_depth = config.getint('workers', 'queue_depth', fallback=worker_processes * 4)
+worker_job_timeout = config.getfloat('workers', 'job_timeout', fallback=30.0)
+
+# Read the transform scheduler: at most `slots` transforms run at once and waiting ones start in
+# order of arrival time plus estimated cost / aging_rate (decoded bytes per second of waiting),
+# so cheap thumbnails overtake large renders. Jobs of heavy_bytes or more use at most heavy_slots.
+scheduler_slots = config.getint('scheduler', 'slots', fallback=worker_processes or os.cpu_count() or 1)
+scheduler_heavy_bytes = config.getint('scheduler', 'heavy_bytes', fallback=64 * 1024 * 1024)
+scheduler_heavy_slots = config.getint('scheduler', 'heavy_slots', fallback=max(1, scheduler_slots // 2))
+scheduler_aging_rate = config.getint('scheduler', 'aging_rate', fallback=32 * 1024 * 1024)
+
+# A transformed image is identified by its origin URL and every transform parameter
+TransformKey = namedtuple('TransformKey', 'url width height format quality resample')
+
+# The response body of a transform, whether it may be stored in the cache,
+# and the version of the origin image it was rendered from
+Derivative = namedtuple('Derivative', 'data mimetype cacheable source', defaults=(None,))
+
+# An origin response with its validators; version is a hash of the body, expires a Unix time,
+# and revalidate is set when the origin forbids using it stale (no-cache, must-revalidate)
+OriginEntry = namedtuple('OriginEntry', 'status content_type data version etag last_modified expires revalidate', defaults=(False,))
+
+
+class TransformError(Exception):
+    def __init__(self, message, status, headers=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.headers = headers or {}
+
+    def __reduce__(self):
+        # Keep the status when the error is raised in a worker process
+        return TransformError, (self.message, self.status, self.headers)
+
+
+class PassthroughRequired(TransformError):
+    # The origin body would be sent unchanged, so it is streamed instead of being downloaded
+    # into memory. Only routes that can stream handle it; elsewhere it is a 415 error.
+    def __init__(self, message='Not an image', status=415, headers=None):
+        super().__init__(message, status, headers)
+
+
+class MemoryCache:
+    # Least recently used entries are evicted once the total size exceeds max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            derivative = self.entries.get(key)
+            if derivative is not None:
+                self.entries.move_to_end(key)
+            return derivative
+
+    def put(self, key, derivative):
+        if len(derivative.data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self.entries[key] = derivative
+            self.size += len(derivative.data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.data)
+
+
+class DiskCache:
+    # Each entry is one file holding the mimetype (and source version, after a tab) on the
+    # first line followed by the body.
+    # Files are evicted in least recently used order once the directory exceeds max_bytes.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Rebuild the index from files left by a previous run, oldest access first.
+        # Temporary files are only removed once stale, since another process may still be writing them.
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Evicted or renamed by another process since the listing
+                continue
+            if name.endswith('.tmp'):
+                if stat.st_mtime < time.time() - 3600:
+                    os.remove(path)
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        with self.lock:
+            self._evict()
+
+    def _name(self, key):
+        return hashlib.sha256(repr(tuple(key)).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            known = name in self.entries
+            if known:
+                self.entries.move_to_end(name)
+        # Unknown names are still tried, since another process sharing the directory may have written them
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                mimetype, _, source = f.readline().rstrip(b'\n').decode('utf-8').partition('\t')
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            if known:
+                with self.lock:
+                    size = self.entries.pop(name, None)
+                    if size is not None:
+                        self.size -= size
+            return None
+        if not known:
+            with self.lock:
+                if name not in self.entries:
+                    self.entries[name] = size
+                    self.size += size
+                    self._evict()
+        return Derivative(data, mimetype, True, source or None)
+
+    def put(self, key, derivative):
+        name = self._name(key)
+        header = derivative.mimetype + ('\t' + derivative.source if derivative.source else '')
+        payload = header.encode('utf-8') + b'\n' + derivative.data
+        if len(payload) > self.max_bytes:
+            return
+
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.size -= old
+            self.entries[name] = len(payload)
+            self.size += len(payload)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class SQLiteCache:
+    # Same interface as DiskCache, but every entry is a row of one SQLite database, so all
+    # processes using the file share entries, access times and the max_bytes limit.
+    # Each write is one transaction and WAL mode lets readers continue during a write.
+    # Access times are only updated once per touch_interval seconds to keep hits read-only.
+    touch_interval = 60
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, mimetype TEXT, source TEXT, '
+                   'data BLOB, size INTEGER, accessed REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        db.execute('CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+        db.execute('INSERT OR IGNORE INTO usage VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM entries))')
+
+    def _db(self):
+        # One connection per thread, opened again after a fork
+        pid, db = getattr(self.local, 'connection', (None, None))
+        if pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = (os.getpid(), db)
+        return db
+
+    def _name(self, key):
+        return hashlib.sha256(repr(tuple(key)).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        name = self._name(key)
+        try:
+            db = self._db()
+            row = db.execute('SELECT mimetype, source, data, accessed FROM entries WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if row[3] < now - self.touch_interval:
+                db.execute('UPDATE entries SET accessed = ? WHERE name = ?', (now, name))
+        except sqlite3.Error:
+            return None
+        return Derivative(row[2], row[0], True, row[1])
+
+    def put(self, key, derivative):
+        name = self._name(key)
+        size = len(derivative.data)
+        if size > self.max_bytes:
+            return
+        try:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                old = db.execute('SELECT size FROM entries WHERE name = ?', (name,)).fetchone()
+                db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                           (name, derivative.mimetype, derivative.source, derivative.data, size, time.time()))
+                db.execute('UPDATE usage SET size = size + ? WHERE id = 0', (size - (old[0] if old else 0),))
+                self._evict(db)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            return
+
+    def _evict(self, db):
+        # Delete the least recently accessed rows, a batch at a time, until the total fits
+        total, = db.execute('SELECT size FROM usage WHERE id = 0').fetchone()
+        while total > self.max_bytes:
+            rows = db.execute('SELECT name, size FROM entries ORDER BY accessed LIMIT 64').fetchall()
+            if not rows:
+                break
+            for name, size in rows:
+                if total <= self.max_bytes:
+                    break
+                db.execute('DELETE FROM entries WHERE name = ?', (name,))
+                total -= size
+        db.execute('UPDATE usage SET size = ? WHERE id = 0', (total,))
+
+
+def create_disk_cache():
+    if cache_backend == 'sqlite':
+        return SQLiteCache(cache_sqlite_path, cache_disk_bytes)
+    return DiskCache(cache_disk_dir, cache_disk_bytes)
+
+
+class DerivativeCache:
+    # The memory cache sits in front of the disk cache; disk hits are promoted to memory.
+    # The disk cache is opened on first use, so worker processes, which import this module
+    # but never read or write derivatives, do not scan or evict it.
+    def __init__(self, memory, open_disk):
+        self.memory = memory
+        self.open_disk = open_disk
+        self.disk = None
+        self.lock = threading.Lock()
+
+    def _disk(self):
+        if self.disk is None:
+            with self.lock:
+                if self.disk is None:
+                    self.disk = self.open_disk()
+        return self.disk
+
+    def get(self, key):
+        derivative = self.memory.get(key)
+        if derivative is not None:
+            return derivative, 'HIT-MEMORY'
+        derivative = self._disk().get(key)
+        if derivative is not None:
+            self.memory.put(key, derivative)
+            return derivative, 'HIT-DISK'
+        return None, 'MISS'
+
+    def put(self, key, derivative):
+        self.memory.put(key, derivative)
+        self._disk().put(key, derivative)
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of the function.
+    # The first caller runs it; later callers wait for its result or its exception.
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        # Return the result and whether it was shared from another caller
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise TransformError('Timed out waiting for image', 504)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class BackgroundRefresher:
+    # Runs refresh jobs on a few background threads, with at most one pending or running job per key
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(threads)
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.executor.submit(self._run, key, fn)
+
+    def _run(self, key, fn):
+        try:
+            fn()
+            metrics.inc('converter_refresh_total', (('result', 'refreshed'),))
+        except Exception:
+            metrics.inc('converter_refresh_total', (('result', 'failed'),))
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+class Metrics:
+    # Counters and histograms rendered in the Prometheus text format.
+    # Updates are a dict lookup and a bisect under one lock, cheap enough for the hot path.
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then +Inf, sum and count
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), values in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {values[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    # Render label pairs as {name="value",...} with the escaping the text format requires
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+metrics = Metrics()
+metrics.describe('converter_stage_seconds', 'histogram', 'Time spent in each pipeline stage.')
+metrics.describe('converter_origin_bytes_total', 'counter', 'Bytes downloaded from origins.')
+metrics.describe('converter_response_bytes_total', 'counter', 'Image bytes sent to clients.')
+metrics.describe('converter_responses_total', 'counter', 'Responses by status code.')
+metrics.describe('converter_origin_content_types_total', 'counter', 'Origin responses by content type.')
+metrics.describe('converter_passthrough_total', 'counter', 'Origin bodies returned without transforming.')
+metrics.describe('converter_cache_total', 'counter', 'Derivative lookups by cache result.')
+metrics.describe('converter_admission_total', 'counter', 'Transforms by admission result (admitted, queued, rejected).')
+metrics.describe('converter_breaker_total', 'counter', 'Circuit breaker events by result (opened, closed, rejected).')
+metrics.describe('converter_peer_total', 'counter', 'Cache misses sent to the owning peer by result (forwarded, fallback).')
+metrics.describe('converter_refresh_total', 'counter', 'Background refreshes of derivatives served stale by result (refreshed, failed).')
+metrics.describe('converter_source_dedup_total', 'counter', 'Renders skipped because identical bytes were already rendered under another URL.')
+metrics.describe('converter_origin_requests_total', 'counter', 'Origin lookups by result (fresh, not_modified, fetched).')
+
+
+class StageTimer:
+    # Records the duration of a with-block as one observation of a pipeline stage
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        metrics.observe('converter_stage_seconds', (('stage', self.stage),), time.perf_counter() - self.start)
+
+
+class SentBody(BytesIO):
+    # A response body that records the send stage when the server closes it after writing
+    def __init__(self, data):
+        super().__init__(data)
+        self.start = time.perf_counter()
+
+    def close(self):
+        if not self.closed:
+            metrics.observe('converter_stage_seconds', (('stage', 'send'),), time.perf_counter() - self.start)
+        super().close()
+
+
+def create_origin_session():
+    # One keep-alive connection pool per origin host, shared by all request threads
+    retry = Retry(
+        total=origin_retries,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=('GET', 'HEAD'),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=origin_pool_connections, pool_maxsize=origin_pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+origin_session = create_origin_session()
+
+# Requests to other converter nodes are not retried; an unreachable owner means rendering locally
+peer_session = requests.Session()
+peer_session.mount('http://', HTTPAdapter(pool_maxsize=origin_pool_maxsize))
+peer_session.mount('https://', HTTPAdapter(pool_maxsize=origin_pool_maxsize))
+
+
+def origin_get(url, **kwargs):
+    # Fetch from the origin through the shared session with connect/read timeouts
+    kwargs.setdefault('timeout', (origin_connect_timeout, origin_read_timeout))
+    return origin_session.get(url, **kwargs)
+
+
+class OriginBody:
+    # Collects an origin body chunk by chunk. The body is rejected as soon as it exceeds
+    # origin_max_bytes, and for image types the header is parsed as soon as enough bytes
+    # have arrived, so images with too many pixels are rejected before the full download.
+    # With passthrough_size, the requested (width, height) of a resize, an image that already
+    # has the resulting size raises PassthroughRequired instead of being downloaded.
+    def __init__(self, content_type, content_length, probe_types, passthrough_size=None):
+        if content_length and content_length.isdigit() and int(content_length) > origin_max_bytes:
+            raise TransformError('Image too large', 413)
+        self.buffer = bytearray()
+        self.probing = bool(probe_types) and content_type.startswith(probe_types)
+        self.size = None
+        self.passthrough_size = passthrough_size
+        metrics.inc('converter_origin_content_types_total', (('content_type', content_type.split(';')[0].strip()),))
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if len(self.buffer) > origin_max_bytes:
+            raise TransformError('Image too large', 413)
+        if self.probing:
+            self._probe()
+
+    def _probe(self):
+        try:
+            with Image.open(BytesIO(self.buffer)) as img:
+                self.size = img.size
+        except Image.DecompressionBombError:
+            raise TransformError('Image too large', 413)
+        except Exception:
+            # Not enough bytes for the header yet; give up after origin_probe_bytes and let decoding decide
+            if len(self.buffer) >= origin_probe_bytes:
+                self.probing = False
+            return
+        self.probing = False
+        if self.size[0] * self.size[1] > origin_max_pixels:
+            raise TransformError('Image too large', 413)
+        if self.passthrough_size is not None and resized_size(self.size, *self.passthrough_size) == self.size:
+            raise PassthroughRequired()
+
+    def getvalue(self):
+        metrics.inc('converter_origin_bytes_total', value=len(self.buffer))
+        return bytes(self.buffer)
+
+
+def read_origin_body(response, probe_types=(), passthrough_size=None):
+    # Stream a requests response opened with stream=True into memory under the OriginBody limits
+    body = OriginBody(response.headers.get('content-type', ''), response.headers.get('content-length'), probe_types, passthrough_size)
+    for chunk in response.iter_content(origin_chunk_size):
+        body.feed(chunk)
+    return body.getvalue()
+
+
+class OriginStore:
+    # Keeps origin bodies with their ETag/Last-Modified and a freshness lifetime from
+    # Cache-Control or Expires. Fresh entries are used without contacting the origin;
+    # stale ones are revalidated with a conditional request.
+    def __init__(self, max_bytes, default_ttl, negative_ttl, stale_while_revalidate):
+        self.entries = MemoryCache(max_bytes)
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_while_revalidate = stale_while_revalidate
+
+    def lookup(self, url):
+        # Return the stored entry, if any, and whether it is still fresh
+        entry = self.entries.get(url)
+        return entry, entry is not None and entry.expires > time.time()
+
+    def serves_stale(self, entry):
+        # Whether a stale entry may still be used while it is revalidated in the background
+        return (entry.status == 200 and not entry.revalidate
+                and entry.expires + self.stale_while_revalidate > time.time())
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def store(self, url, status, headers, content_type, data):
+        # Build an entry from a full origin response and keep it if the origin allows caching
+        cache_control = parse_cache_control_header(headers.get('cache-control'), cls=ResponseCacheControl)
+        entry = OriginEntry(status, content_type, data, hashlib.sha256(data).hexdigest(),
+                            headers.get('etag'), headers.get('last-modified'), time.time() + self._lifetime(headers),
+                            bool(cache_control.no_cache or cache_control.must_revalidate))
+        if status == 200 and not cache_control.no_store:
+            self.entries.put(url, entry)
+        elif status in (404, 410) and not cache_control.no_store:
+            # Remember missing images briefly so they do not reach the origin on every request
+            entry = entry._replace(expires=time.time() + self.negative_ttl)
+            self.entries.put(url, entry)
+        return entry
+
+    def refresh(self, url, entry, headers):
+        # The origin answered 304: keep the body and version, update validators and lifetime
+        cache_control = parse_cache_control_header(headers.get('cache-control'), cls=ResponseCacheControl)
+        entry = entry._replace(etag=headers.get('etag') or entry.etag,
+                               last_modified=headers.get('last-modified') or entry.last_modified,
+                               expires=time.time() + self._lifetime(headers),
+                               revalidate=bool(cache_control.no_cache or cache_control.must_revalidate))
+        self.entries.put(url, entry)
+        return entry
+
+    def _lifetime(self, headers):
+        cache_control = parse_cache_control_header(headers.get('cache-control'), cls=ResponseCacheControl)
+        if cache_control.no_cache:
+            return 0
+        # We are a shared cache, so s-maxage takes precedence over max-age
+        max_age = cache_control.s_maxage if cache_control.s_maxage is not None else cache_control.max_age
+        if max_age is not None:
+            age = headers.get('age')
+            return max(0, max_age - (int(age) if age and age.isdigit() else 0))
+        expires = parse_date(headers.get('expires'))
+        if expires is not None:
+            date = parse_date(headers.get('date')) or datetime.now(timezone.utc)
+            return max(0, (expires - date).total_seconds())
+        # Heuristic freshness: 10% of the time since Last-Modified, capped at the default lifetime
+        last_modified = parse_date(headers.get('last-modified'))
+        if last_modified is not None:
+            return min(self.default_ttl, max(0, (datetime.now(timezone.utc) - last_modified).total_seconds() / 10))
+        return self.default_ttl
+
+
+def resample_key(resample):
+    # Renders made with the fast downscale strategy are cached separately from full-quality ones
+    return resample + '+reduce' if fast_downscale else resample
+
+
+def draft_image(img, size):
+    # With fast_downscale, ask the JPEG decoder for a 1/2, 1/4 or 1/8 scale image (draft mode)
+    # that is still at least reducing_gap times larger than the target. Must run before loading.
+    if fast_downscale:
+        img.draft(None, (max(1, int(size[0] * reducing_gap)), max(1, int(size[1] * reducing_gap))))
+
+
+def downscale_image(img, size, resample=None):
+    # With fast_downscale, reduce in integer steps before the final resample
+    if not fast_downscale:
+        return img.resize(size, resample=resample)
+    return img.resize(size, resample=resample, reducing_gap=reducing_gap)
+
+
+def transform_image(data, size, resample, image_format, save_options):
+    # Decode, optionally resize, and encode an image. Runs in a worker process,
+    # so it only takes and returns plain values: the encoded bytes and the
+    # decode, resize and encode durations.
+    timings = []
+    with Image.open(BytesIO(data)) as img:
+        start = time.perf_counter()
+        if size is not None:
+            draft_image(img, size)
+        img.load()
+        timings.append(('decode', time.perf_counter() - start))
+
+        if size is not None:
+            start = time.perf_counter()
+            img = downscale_image(img, size, resample)
+            timings.append(('resize', time.perf_counter() - start))
+
+        start = time.perf_counter()
+        img_io = BytesIO()
+        img.save(img_io, image_format, **save_options)
+        timings.append(('encode', time.perf_counter() - start))
+        return img_io.getvalue(), timings
+
+
+def transform_image_sizes(data, sizes, resample, image_format, save_options):
+    # Decode once and produce every size by downscaling from the largest to the smallest,
+    # each step starting from the previous result. Runs in a worker process like
+    # transform_image and returns the encoded images in the order of sizes, with timings.
+    timings = []
+    encoded = [None] * len(sizes)
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i][0] * sizes[i][1], reverse=True)
+    with Image.open(BytesIO(data)) as img:
+        start = time.perf_counter()
+        draft_image(img, sizes[order[0]])
+        img.load()
+        timings.append(('decode', time.perf_counter() - start))
+
+        for i in order:
+            start = time.perf_counter()
+            if img.size != sizes[i]:
+                img = downscale_image(img, sizes[i], resample)
+            timings.append(('resize', time.perf_counter() - start))
+
+            start = time.perf_counter()
+            img_io = BytesIO()
+            img.save(img_io, image_format, **save_options)
+            encoded[i] = img_io.getvalue()
+            timings.append(('encode', time.perf_counter() - start))
+    return encoded, timings
+
+
+class CircuitBreaker:
+    # Tracks consecutive connection errors, timeouts and 5xx responses per origin host.
+    # Once a host reaches `failures`, requests to it fail fast with 503 for reset_timeout
+    # seconds; then one probe request is let through, which closes the circuit on success
+    # or opens it again on failure.
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def before(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None or state['opened'] is None:
+                return
+            remaining = state['opened'] + self.reset_timeout - time.monotonic()
+            if remaining > 0 or state['probing']:
+                metrics.inc('converter_breaker_total', (('result', 'rejected'),))
+                raise TransformError('Origin unavailable', 503, {'Retry-After': str(max(1, math.ceil(remaining)))})
+            state['probing'] = True
+
+    def success(self, host):
+        with self.lock:
+            if self.hosts.pop(host, None) is not None:
+                metrics.inc('converter_breaker_total', (('result', 'closed'),))
+
+    def failure(self, host):
+        with self.lock:
+            state = self.hosts.setdefault(host, {'count': 0, 'opened': None, 'probing': False})
+            state['count'] += 1
+            if state['count'] >= self.failures or state['probing']:
+                if state['opened'] is None or state['probing']:
+                    metrics.inc('converter_breaker_total', (('result', 'opened'),))
+                state['opened'] = time.monotonic()
+                state['probing'] = False
+
+    def cancel(self, host):
+        # The probe was abandoned without an answer; let the next request probe instead
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is not None:
+                state['probing'] = False
+
+
+class FailureCache:
+    # Remembers render errors for ttl seconds so requests for known-bad images fail
+    # without fetching or decoding again. Holds at most max_entries errors.
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                del self.entries[key]
+                return None
+            return item[0]
+
+    def put(self, key, error, expires):
+        with self.lock:
+            self.entries[key] = (error, min(expires, time.time() + self.ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DomainAllowlist:
+    # Entries match a hostname exactly; entries starting with '*.' match any subdomain.
+    # A lookup is one set probe per label of the hostname, however many entries there are.
+    def __init__(self, domains):
+        self.exact = set()
+        self.suffixes = set()
+        for domain in domains:
+            domain = domain.strip().lower().rstrip('.')
+            if domain.startswith('*.'):
+                self.suffixes.add(domain[2:])
+            elif domain:
+                self.exact.add(domain)
+
+    def __len__(self):
+        return len(self.exact) + len(self.suffixes)
+
+    def allows(self, hostname):
+        hostname = hostname.lower().rstrip('.')
+        if hostname in self.exact:
+            return True
+        position = hostname.find('.')
+        while position != -1:
+            if hostname[position + 1:] in self.suffixes:
+                return True
+            position = hostname.find('.', position + 1)
+        return False
+
+
+class AllowlistReloader:
+    # Rebuilds the allowlist when config.ini changes, checking its modification time at most
+    # once per interval. A file that fails to parse keeps the previous allowlist.
+    def __init__(self, path, interval, allowlist):
+        self.path = path
+        self.interval = interval
+        self.allowlist = allowlist
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self):
+        now = time.monotonic()
+        if now - self.checked < self.interval or not self.lock.acquire(blocking=False):
+            return self.allowlist
+        try:
+            self.checked = now
+            mtime = self._mtime()
+            if mtime is not None and mtime != self.mtime:
+                self.mtime = mtime
+                self._reload()
+        finally:
+            self.lock.release()
+        return self.allowlist
+
+    def _reload(self):
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(self.path)
+            domains = parser.get('app', 'allowed_domains').split(',')
+        except configparser.Error as e:
+            app.logger.warning('Keeping the previous allowed_domains, %s could not be read: %s', self.path, e)
+            return
+        self.allowlist = DomainAllowlist(domains)
+        app.logger.info('Reloaded %d allowed domains from %s', len(self.allowlist), self.path)
+
+
+class SizeBuckets:
+    # Rounds a requested dimension up to the next breakpoint, or to a multiple of step.
+    # Sizes above the largest breakpoint are capped to it; 0 (keep aspect ratio) is kept.
+    def __init__(self, breakpoints, step):
+        self.breakpoints = breakpoints
+        self.step = step
+
+    def __bool__(self):
+        return bool(self.breakpoints or self.step > 0)
+
+    def snap(self, value):
+        if value == 0:
+            return value
+        if self.breakpoints:
+            index = bisect.bisect_left(self.breakpoints, value)
+            return self.breakpoints[min(index, len(self.breakpoints) - 1)]
+        if self.step > 0:
+            return -(-value // self.step) * self.step
+        return value
+
+    def snap_size(self, width, height):
+        # With both dimensions given, the width picks the bucket and the height keeps its ratio
+        if width and height:
+            bucket_width = self.snap(width)
+            return bucket_width, max(1, round(height * bucket_width / width))
+        return self.snap(width), self.snap(height)
+
+
+def bucketed_path(path, width, height, bucket_width, bucket_height):
+    # The request path with its size segment replaced by the bucketed size
+    return path.replace(f'/{width}x{height}/', f'/{bucket_width}x{bucket_height}/', 1)
+
+
+class HashRing:
+    # Consistent hashing of transform keys onto nodes. Each node is placed at `replicas`
+    # points of a 64-bit ring and owns the keys hashing between the previous point and its
+    # own, so adding or removing a node only moves the keys next to its points.
+    def __init__(self, nodes, replicas):
+        self.points = sorted((self._hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def _hash(self, text):
+        return int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.hashes, self._hash(repr(tuple(key)))) % len(self.points)
+        return self.points[index][1]
+
+
+class MemoryBudget:
+    # Admits transforms while the estimated decoded size of all admitted ones stays under
+    # max_bytes. Callers wait up to timeout for room and then get 503 with Retry-After.
+    # A single image larger than the whole budget could never fit and is rejected with 413.
+    def __init__(self, max_bytes, timeout, retry_after):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cost):
+        if cost > self.max_bytes:
+            metrics.inc('converter_admission_total', (('result', 'rejected'),))
+            raise TransformError('Image too large', 413)
+        with self.condition:
+            if self._fits(cost):
+                metrics.inc('converter_admission_total', (('result', 'admitted'),))
+            elif self.condition.wait_for(lambda: self._fits(cost), self.timeout):
+                metrics.inc('converter_admission_total', (('result', 'queued'),))
+            else:
+                metrics.inc('converter_admission_total', (('result', 'rejected'),))
+                raise TransformError('Server busy', 503, {'Retry-After': str(self.retry_after)})
+            self.used += cost
+
+    def release(self, cost):
+        with self.condition:
+            self.used -= cost
+            self.condition.notify_all()
+
+    def _fits(self, cost):
+        return self.used + cost <= self.max_bytes
+
+
+class TransformScheduler:
+    # Orders transforms waiting for a slot by estimated work instead of arrival. Each job gets
+    # a deadline of its arrival time plus cost / aging_rate, capped at half the wait timeout, and
+    # the earliest deadline that may start goes first. Small jobs overtake large ones, but only
+    # those arriving before the large job's deadline, so it cannot starve. Heavy jobs take at
+    # most heavy_slots of the slots. Beyond queue_depth waiting jobs, or after waiting timeout
+    # seconds, requests get 503, except the job at the head of the queue, which keeps waiting
+    # for a slot to be released.
+    def __init__(self, slots, heavy_slots, heavy_cost, aging_rate, queue_depth, timeout, retry_after):
+        self.slots = slots
+        self.heavy_slots = heavy_slots
+        self.heavy_cost = heavy_cost
+        self.aging_rate = aging_rate
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.running = 0
+        self.heavy_running = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def acquire(self, cost):
+        # Wait for this job's turn; returns whether it is heavy, to be passed to release
+        heavy = cost >= self.heavy_cost
+        entry = (time.monotonic() + min(cost / self.aging_rate, self.timeout / 2), next(self.sequence), heavy)
+        with self.condition:
+            if len(self.waiting) >= self.queue_depth and self.running >= self.slots:
+                raise TransformError('Server busy', 503, {'Retry-After': str(self.retry_after)})
+            bisect.insort(self.waiting, entry)
+            try:
+                started = self.condition.wait_for(lambda: self._next() == entry, self.timeout)
+                if not started and self.waiting[0] == entry:
+                    # Jobs arriving from now on have later deadlines, so this one stays first
+                    started = self.condition.wait_for(lambda: self._next() == entry)
+            finally:
+                self.waiting.remove(entry)
+                self.condition.notify_all()
+            if not started:
+                raise TransformError('Server busy', 503, {'Retry-After': str(self.retry_after)})
+            self.running += 1
+            if heavy:
+                self.heavy_running += 1
+        return heavy
+
+    def release(self, heavy):
+        with self.condition:
+            self.running -= 1
+            if heavy:
+                self.heavy_running -= 1
+            self.condition.notify_all()
+
+    def _next(self):
+        # The waiting job with the earliest deadline among those allowed to start now
+        if self.running >= self.slots:
+            return None
+        for entry in self.waiting:
+            if not entry[2] or self.heavy_running < self.heavy_slots:
+                return entry
+        return None
+
+
+def estimate_decoded_bytes(data, sizes):
+    # Memory needed to decode the image and hold the resized copies, from its header only.
+    # Also enforces max_pixels for images that were not probed while downloading, and for
+    # the requested sizes, which may be much larger than the source.
+    if any(size[0] * size[1] > origin_max_pixels for size in sizes):
+        raise TransformError('Image too large', 413)
+    with Image.open(BytesIO(data)) as img:
+        if img.size[0] * img.size[1] > origin_max_pixels:
+            raise TransformError('Image too large', 413)
+        bands = len(img.getbands())
+        if sizes:
+            # The JPEG decoder only produces the draft size
+            draft_image(img, max(sizes, key=lambda size: size[0] * size[1]))
+        width, height = img.size
+    return bands * (width * height + sum(size[0] * size[1] for size in sizes))
+
+
+class TransformPool:
+    # Runs CPU-bound transforms in worker processes so request threads only do I/O.
+    # At most processes + queue_depth jobs may be submitted at once; beyond that requests get 503.
+    def __init__(self, processes, queue_depth, timeout):
+        self.processes = processes
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(processes + queue_depth) if processes > 0 else None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        # Workers are started on first use with spawn, since forking a threaded server is unsafe
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def _reset_executor(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args, on_done=None):
+        # on_done is called once the job has finished or was never started, even if the
+        # caller stopped waiting for it, so whatever it releases is held while a worker runs
+        on_done = on_done or (lambda: None)
+        if self.processes <= 0:
+            try:
+                return fn(*args)
+            finally:
+                on_done()
+
+        if not self.slots.acquire(blocking=False):
+            on_done()
+            raise TransformError('Server busy', 503, {'Retry-After': str(admission_retry_after)})
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            on_done()
+            self._reset_executor(executor)
+            raise TransformError('Image processing failed', 500)
+
+        def finished(future):
+            # The slot is held until the job really finishes, even if the caller stops waiting
+            self.slots.release()
+            on_done()
+
+        future.add_done_callback(finished)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise TransformError('Image processing timed out', 504)
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            raise TransformError('Image processing failed', 500)
+
+
+derivative_cache = DerivativeCache(MemoryCache(cache_memory_bytes), create_disk_cache)
+render_flight = SingleFlight(coalesce_timeout)
+transform_pool = TransformPool(worker_processes, worker_queue_depth, worker_job_timeout)
+transform_scheduler = TransformScheduler(scheduler_slots, scheduler_heavy_slots, scheduler_heavy_bytes, scheduler_aging_rate,
+                                         worker_queue_depth, admission_wait, admission_retry_after)
+origin_store = OriginStore(origin_store_bytes, origin_default_ttl, negative_ttl, stale_while_revalidate)
+refresher = BackgroundRefresher(refresh_threads)
+origin_flight = SingleFlight(coalesce_timeout)
+size_buckets = SizeBuckets(bucket_breakpoints, bucket_step)
+batch_executor = ThreadPoolExecutor(batch_threads)
+origin_breaker = CircuitBreaker(breaker_failures, breaker_reset_timeout)
+failed_renders = FailureCache(10000, negative_ttl)
+memory_budget = MemoryBudget(admission_memory_bytes, admission_wait, admission_retry_after)
+allowlist = AllowlistReloader('config.ini', config_reload_interval, DomainAllowlist(allowed_domains))
+peer_ring = HashRing(peer_nodes, peer_replicas)
+peer_flight = SingleFlight(coalesce_timeout)
+peer_breaker = CircuitBreaker(breaker_failures, breaker_reset_timeout)
+
+
+def run_scheduled(cost, fn, *args):
+    # Run fn in the worker pool once the scheduler and the memory budget admit it, and record
+    # its stage timings. The estimated decoded size doubles as the scheduler's cost of the job.
+    with StageTimer('queue'):
+        heavy = transform_scheduler.acquire(cost)
+    try:
+        memory_budget.acquire(cost)
+    except TransformError:
+        transform_scheduler.release(heavy)
+        raise
+
+    def finished():
+        # The worker is done; a caller that timed out must not give these back any earlier
+        memory_budget.release(cost)
+        transform_scheduler.release(heavy)
+
+    result, timings = transform_pool.run(fn, *args, on_done=finished)
+    for stage, seconds in timings:
+        metrics.observe('converter_stage_seconds', (('stage', stage),), seconds)
+    return result
+
+
+def run_transform(data, size, resample, image_format, save_options):
+    cost = estimate_decoded_bytes(data, [size] if size is not None else [])
+    return run_scheduled(cost, transform_image, data, size, resample, image_format, save_options)
+
+
+def run_transform_sizes(data, sizes, resample, image_format, save_options):
+    cost = estimate_decoded_bytes(data, sizes)
+    return run_scheduled(cost, transform_image_sizes, data, sizes, resample, image_format, save_options)
+
+
+def passthrough(data, content_type, cacheable):
+    # The origin body is returned unchanged
+    metrics.inc('converter_passthrough_total')
+    return Derivative(data, content_type, cacheable)
+
+
+def download_passthrough(image_url):
+    # The origin body unchanged, for callers that cannot stream it with stream_origin
+    try:
+        origin = fetch_origin(image_url)
+    except requests.exceptions.RequestException as e:
+        raise TransformError('Error retrieving image: ' + str(e), 500)
+    if origin.status != 200:
+        raise TransformError('Failed to download image', 500)
+    return passthrough(origin.data, origin.content_type, False)
+
+
+def fetch_origin(image_url, probe_types=(), stream_others=False, passthrough_size=None):
+    # Get the origin image through the origin store. Fresh entries need no request, stale
+    # ones are revalidated, and concurrent fetches of the same URL share one request.
+    # With stream_others, a 200 response of a type outside probe_types is not downloaded
+    # and PassthroughRequired is raised, so the caller can stream it with stream_origin.
+    # The same happens for an image a resize to passthrough_size would leave unchanged.
+    entry, fresh = origin_store.lookup(image_url)
+    if fresh:
+        metrics.inc('converter_origin_requests_total', (('result', 'fresh'),))
+        return entry
+
+    def request_origin():
+        with StageTimer('fetch'), origin_get(image_url, stream=True, headers=origin_store.conditional_headers(entry)) as response:
+            if response.status_code == 304 and entry is not None:
+                metrics.inc('converter_origin_requests_total', (('result', 'not_modified'),))
+                return origin_store.refresh(image_url, entry, response.headers)
+            if stream_others and response.status_code == 200 and not response.headers.get('content-type', '').startswith(probe_types):
+                raise PassthroughRequired()
+            data = read_origin_body(response, probe_types, passthrough_size)
+        metrics.inc('converter_origin_requests_total', (('result', 'fetched'),))
+        return origin_store.store(image_url, response.status_code, response.headers, response.headers.get('content-type', ''), data)
+
+    def fetch():
+        # Requests to an origin that keeps failing are refused by the circuit breaker
+        host = urlsplit(image_url).netloc
+        origin_breaker.before(host)
+        try:
+            result = request_origin()
+        except requests.exceptions.RequestException:
+            origin_breaker.failure(host)
+            raise
+        except BaseException:
+            # The origin answered, but the body was rejected (e.g. too large)
+            origin_breaker.success(host)
+            raise
+        if result.status >= 500:
+            origin_breaker.failure(host)
+        else:
+            origin_breaker.success(host)
+        return result
+
+    # Callers expecting different types or sizes must not share a PassthroughRequired
+    return origin_flight.do((image_url, probe_types, stream_others, passthrough_size), fetch)[0]
+
+
+def content_key(key, source):
+    # Derivatives are stored under the content hash of their origin body instead of its URL,
+    # so URLs serving identical bytes (cache busters, mirrors) share one set of derivatives
+    return key._replace(url='sha256:' + source)
+
+
+def source_index_key(url):
+    # The URL -> content hash index is kept in the derivative cache as tiny entries,
+    # so it survives restarts along with the disk cache
+    return TransformKey(url, 0, 0, 'source', None, None)
+
+
+def known_source(url, serve_stale=False):
+    # The content hash currently behind a URL, without downloading it if possible, and whether
+    # it is stale and should be refreshed in the background. With serve_stale, a stale origin
+    # entry within stale_while_revalidate, or a hash only known from the index, is returned
+    # right away. Otherwise a stale entry is revalidated first, so a 304 keeps the hash; if the
+    # origin cannot be reached the last known hash is used for up to max_stale seconds. A hash
+    # only known from the index is not used then: rendering downloads the origin again and
+    # process_or_reuse finds the derivatives if the bytes did not change.
+    entry, fresh = origin_store.lookup(url)
+    if entry is not None and not fresh:
+        if serve_stale and origin_store.serves_stale(entry):
+            return entry.version, True
+        try:
+            result = fetch_origin(url)
+        except (requests.exceptions.RequestException, TransformError):
+            result = None
+        entry = revalidated_entry(entry, result)
+        if entry is None:
+            return None, False
+    return indexed_source(url, entry, serve_stale)
+
+
+def revalidated_entry(entry, result):
+    # The entry to use after revalidating a stale one: the origin's answer, or the stale
+    # entry for up to max_stale seconds while the origin fails or answers 5xx
+    if result is not None and result.status < 500:
+        return result
+    if entry.expires + max_stale < time.time():
+        return None
+    return entry
+
+
+def indexed_source(url, entry, serve_stale):
+    # The hash of a usable origin entry, otherwise the last hash recorded for the URL.
+    # Once the origin answers 404 or 410 the record is cleared, so the derivatives of the
+    # removed image are not served again when its origin entry is evicted.
+    if entry is not None:
+        if entry.status in (404, 410):
+            forget_source(url)
+        return (entry.version, False) if entry.status == 200 else (None, False)
+    if not serve_stale:
+        return None, False
+    record, _ = derivative_cache.get(source_index_key(url))
+    if record is None or record.source is None:
+        return None, False
+    return record.source, True
+
+
+def forget_source(url):
+    # Overwrite the URL's index record with one holding no hash
+    record, _ = derivative_cache.get(source_index_key(url))
+    if record is not None and record.source is not None:
+        derivative_cache.put(source_index_key(url), Derivative(b'', 'text/plain', True))
+
+
+def lookup_derivative(key, serve_stale=False):
+    return source_derivative(key, *known_source(key.url, serve_stale))
+
+
+def source_derivative(key, source, stale):
+    # The cached derivative of key rendered from the given content hash
+    if source is None:
+        return None, 'MISS'
+    derivative, cache_status = derivative_cache.get(content_key(key, source))
+    if derivative is not None and stale:
+        return derivative, 'STALE'
+    return derivative, cache_status
+
+
+def store_derivative(key, derivative):
+    # Store a rendered derivative by content and point the URL at that content
+    if not derivative.cacheable or derivative.source is None:
+        return
+    derivative_cache.put(content_key(key, derivative.source), derivative)
+    derivative_cache.put(source_index_key(key.url), Derivative(derivative.source.encode('ascii'), 'text/plain', True, derivative.source))
+
+
+def process_or_reuse(key, origin, process, *args):
+    # Identical bytes may already have been rendered under another URL
+    derivative, _ = derivative_cache.get(content_key(key, origin.version))
+    if derivative is not None:
+        metrics.inc('converter_source_dedup_total')
+        return derivative
+    return process(origin.content_type, origin.data, *args)._replace(source=origin.version)
+
+
+def parse_image_url(url):
+    # Parse the remote URL and URI from the request
+    match = re.match(r'(https?://[^/]+)(/.*)', url)
+    if not match:
+        raise TransformError('Invalid URL', 400)
+    remote_url, uri = match.groups()
+
+    # Userinfo and backslashes in the host part are read differently by different URL parsers,
+    # so they are refused. The URL is checked and rebuilt with the parser the origin client
+    # uses, so the host that was allowed is the host that gets fetched.
+    if '@' in remote_url or '\\' in remote_url:
+        raise TransformError('Invalid URL', 400)
+    try:
+        parsed = parse_url(remote_url + uri)
+    except LocationParseError:
+        raise TransformError('Invalid URL', 400)
+
+    # Check if the remote URL host is in the allowed domains list
+    hostname = (parsed.host or '').strip('[]')
+    if not hostname or not allowlist.get().allows(hostname):
+        raise TransformError('Access denied', 403)
+    return parsed.url
+
+
+def derivative_etag(key, derivative):
+    # A strong validator from the transform key and the origin version it was rendered from,
+    # so it can be computed before rendering. Derivatives without a version hash their body.
+    if derivative.source is None:
+        return hashlib.sha256(derivative.data).hexdigest()[:32]
+    return source_etag(key, derivative.source)
+
+
+def source_etag(key, source):
+    return hashlib.sha256(repr((tuple(key), source)).encode('utf-8')).hexdigest()[:32]
+
+
+def etag_matches(if_none_match, etag):
+    return etag is not None and parse_etags(if_none_match).contains(etag)
+
+
+def known_etag(key):
+    # The ETag a request would get, if the origin image is in the origin store and still fresh
+    entry, fresh = origin_store.lookup(key.url)
+    if fresh and entry.status == 200:
+        return source_etag(key, entry.version)
+    return None
+
+
+def caching_headers(etag):
+    if etag is None:
+        return {'Cache-Control': 'no-store'}
+    return {'ETag': quote_etag(etag), 'Cache-Control': http_cache_control}
+
+
+def remember_failure(key, error):
+    # A render error is remembered while the origin response it came from is fresh, so it
+    # depends only on known origin bytes. Busy and timeout errors are never remembered.
+    # Passthroughs are remembered for negative_ttl so the next requests stream right away.
+    if isinstance(error, PassthroughRequired):
+        failed_renders.put(key, error, time.time() + negative_ttl)
+        return
+    if error.status in (503, 504):
+        return
+    entry, fresh = origin_store.lookup(key.url)
+    if fresh:
+        failed_renders.put(key, error, entry.expires)
+
+
+def get_derivative(key, render, forward=True, serve_stale=True):
+    # Serve from the cache when possible, otherwise render and store the result.
+    # Identical requests arriving during the render wait for it instead of rendering again.
+    # In peer mode, keys owned by another node are rendered by that node unless forward is False.
+    # Stale derivatives are served as they are and refreshed in the background.
+    error = failed_renders.get(key)
+    if error is not None:
+        raise type(error)(error.message, error.status, error.headers)
+
+    derivative, cache_status = lookup_derivative(key, serve_stale)
+    if cache_status == 'STALE':
+        refresher.submit(key, lambda: refresh_derivative(key, render, forward))
+        return derivative, cache_status
+    owner = peer_owner(key) if derivative is None and forward else None
+    if owner is not None:
+        derivative, shared = peer_flight.do(key, lambda: forward_derivative(owner, key))
+        if derivative is not None:
+            return derivative, 'COALESCED' if shared else 'PEER'
+    if derivative is None:
+        def render_and_store():
+            try:
+                derivative = render()
+            except TransformError as e:
+                remember_failure(key, e)
+                raise
+            store_derivative(key, derivative)
+            return derivative
+
+        derivative, shared = render_flight.do(key, render_and_store)
+        if shared:
+            cache_status = 'COALESCED'
+    return derivative, cache_status
+
+
+def refresh_derivative(key, render, forward):
+    # Revalidate the origin of a derivative that was served stale, then render it again if the
+    # image changed. An origin only known from the index is downloaded again to compare.
+    fetch_origin(key.url)
+    get_derivative(key, render, forward, serve_stale=False)
+
+
+def peer_owner(key):
+    # The node that renders and stores key, or None when it is this node or peer mode is off
+    owner = peer_ring.owner(key)
+    return owner if owner != peer_self else None
+
+
+def peer_job(key):
+    # The batch job that builds key, so the owner validates and renders it like any other job
+    image_format = 'original' if key.format == 'original' else 'webp'
+    return {'url': key.url, 'width': key.width, 'height': key.height, 'format': image_format}
+
+
+def peer_derivative_headers(derivative, cache_status):
+    headers = {'X-Cache': cache_status, 'X-Cacheable': '1' if derivative.cacheable else '0'}
+    if derivative.source is not None:
+        headers['X-Source'] = derivative.source
+    return headers
+
+
+def peer_response(status, headers, body):
+    # Turn the owner's answer to /peer/derivative back into a derivative or the error it reported
+    if status == 200:
+        return Derivative(body, headers.get('content-type', ''), headers.get('x-cacheable') == '1', headers.get('x-source'))
+    if headers.get('x-passthrough'):
+        raise PassthroughRequired()
+    retry_after = headers.get('retry-after')
+    raise TransformError(body.decode('utf-8', 'replace'), status, {'Retry-After': retry_after} if retry_after else None)
+
+
+def forward_derivative(owner, key):
+    # Ask the owning node for key. Returns None when the owner cannot be reached, so the
+    # caller renders locally; errors reported by the owner are raised as they are.
+    try:
+        peer_breaker.before(owner)
+    except TransformError:
+        metrics.inc('converter_peer_total', (('result', 'fallback'),))
+        return None
+    try:
+        with StageTimer('peer'):
+            response = peer_session.post(owner + '/peer/derivative', json=peer_job(key),
+                                         timeout=(peer_connect_timeout, peer_read_timeout))
+    except requests.exceptions.RequestException:
+        peer_breaker.failure(owner)
+        metrics.inc('converter_peer_total', (('result', 'fallback'),))
+        return None
+    peer_breaker.success(owner)
+    metrics.inc('converter_peer_total', (('result', 'forwarded'),))
+    return peer_response(response.status_code, response.headers, response.content)
+
+
+def origin_response_headers(headers):
+    return {name: headers[name] for name in passthrough_headers if name in headers}
+
+
+def stored_passthrough_headers(entry):
+    # Headers for an origin body served from the origin store, fresh for as long as the entry
+    headers = {'Content-Type': entry.content_type, 'Cache-Control': f'max-age={int(entry.expires - time.time())}', 'X-Cache': 'HIT-ORIGIN'}
+    if entry.etag:
+        headers['ETag'] = entry.etag
+    if entry.last_modified:
+        headers['Last-Modified'] = entry.last_modified
+    return headers
+
+
+def passthrough_not_modified(entry, request_headers):
+    # Whether the client's conditional headers match a stored origin response
+    if 'If-None-Match' in request_headers:
+        return bool(entry.etag) and parse_etags(request_headers['If-None-Match']).contains_raw(entry.etag)
+    return bool(entry.last_modified) and request_headers.get('If-Modified-Since') == entry.last_modified
+
+
+def passthrough_request_headers(request_headers):
+    # The client's conditional headers, and its Accept-Encoding since the body is relayed
+    # with whatever Content-Encoding the origin chooses (identity if the client sent none)
+    headers = {name: request_headers[name] for name in ('If-None-Match', 'If-Modified-Since') if name in request_headers}
+    headers['Accept-Encoding'] = request_headers.get('Accept-Encoding', 'identity')
+    return headers
+
+
+def stream_origin(image_url):
+    # Send the origin body unchanged as it arrives, forwarding its validators and the
+    # client's conditional headers. Bodies up to passthrough_cache_bytes are kept in the
+    # origin store on the way. Returns None unless the origin answers 200 or 304.
+    entry, fresh = origin_store.lookup(image_url)
+    if fresh:
+        if entry.status != 200:
+            return None
+        headers = stored_passthrough_headers(entry)
+        if passthrough_not_modified(entry, request.headers):
+            return Response(status=304, headers=headers)
+        metrics.inc('converter_passthrough_total')
+        metrics.inc('converter_response_bytes_total', value=len(entry.data))
+        return Response(entry.data, headers=headers)
+
+    host = urlsplit(image_url).netloc
+    origin_breaker.before(host)
+    try:
+        response = origin_get(image_url, stream=True, headers=passthrough_request_headers(request.headers))
+    except requests.exceptions.RequestException as e:
+        origin_breaker.failure(host)
+        raise TransformError('Error retrieving image: ' + str(e), 500)
+    if response.status_code >= 500:
+        origin_breaker.failure(host)
+    else:
+        origin_breaker.success(host)
+
+    headers = origin_response_headers(response.headers)
+    headers['X-Cache'] = 'STREAM'
+    if response.status_code == 304:
+        response.close()
+        return Response(status=304, headers=headers)
+    if response.status_code != 200:
+        response.close()
+        return None
+    metrics.inc('converter_passthrough_total')
+    metrics.inc('converter_origin_content_types_total', (('content_type', headers.get('Content-Type', '').split(';')[0].strip()),))
+
+    def generate():
+        # The raw stream keeps any Content-Encoding, so Content-Length stays valid
+        kept, size = [], 0
+        try:
+            for chunk in response.raw.stream(origin_chunk_size, decode_content=False):
+                size += len(chunk)
+                if kept is not None and size <= passthrough_cache_bytes:
+                    kept.append(chunk)
+                else:
+                    kept = None
+                yield chunk
+        finally:
+            response.close()
+            metrics.inc('converter_origin_bytes_total', value=size)
+            metrics.inc('converter_response_bytes_total', value=size)
+        if kept is not None and 'Content-Encoding' not in headers:
+            origin_store.store(image_url, 200, response.headers, headers.get('Content-Type', ''), b''.join(kept))
+
+    return Response(generate(), headers=headers)
+
+
+def serve_derivative(key, render):
+    # Answer If-None-Match without rendering or reading the cache when the origin version is known
+    etag = known_etag(key)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        metrics.inc('converter_cache_total', (('result', 'NOT-MODIFIED'),))
+        return Response(status=304, headers=caching_headers(etag))
+
+    try:
+        derivative, cache_status = get_derivative(key, render)
+    except PassthroughRequired:
+        try:
+            return stream_origin(key.url) or ('Failed to download image', 500)
+        except TransformError as e:
+            return e.message, e.status, e.headers
+    except TransformError as e:
+        return e.message, e.status, e.headers
+
+    # Non-image passthroughs are not cached by us, so clients must not cache them either
+    etag = derivative_etag(key, derivative) if derivative.cacheable else None
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        metrics.inc('converter_cache_total', (('result', 'NOT-MODIFIED'),))
+        return Response(status=304, headers=caching_headers(etag))
+
+    metrics.inc('converter_cache_total', (('result', cache_status),))
+    metrics.inc('converter_response_bytes_total', value=len(derivative.data))
+    response = send_file(SentBody(derivative.data), mimetype=derivative.mimetype)
+    response.headers.update(caching_headers(etag))
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+@app.after_request
+def count_response(response):
+    metrics.inc('converter_responses_total', (('status', str(response.status_code)),))
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/<int:width>x<int:height>/<path:url>')
 def resize_image(width, height, url):
     # Validate input values
     if width < 0 or height < 0:
         return 'Invalid input', 400
 
-    # Parse the remote URL and URI from the request
-    match = re.match(r'(https?://[^/]+)(/.*)', url)
-    if not match:
-        return 'Invalid URL', 400
-    remote_url, uri = match.groups()
+    try:
+        image_url = parse_image_url(url)
+    except TransformError as e:
+        return e.message, e.status, e.headers
 
-    # Check if the remote URL domain is in the allowed domains list
-    if not any(domain in remote_url for domain in allowed_domains):
-        return 'Access denied', 403
+    # Snap the requested size to its bucket
+    bucket_width, bucket_height = size_buckets.snap_size(width, height)
+    if (bucket_width, bucket_height) != (width, height):
+        if bucket_mode == 'redirect':
+            return redirect(bucketed_path(request.full_path.rstrip('?'), width, height, bucket_width, bucket_height))
+        width, height = bucket_width, bucket_height
 
-    # Check if the file format is JPEG, PNG, or WEBP
+    # The original is sent unchanged, so stream it instead of downloading it first
+    if width == 0 and height == 0:
+        try:
+            response = stream_origin(image_url)
+        except TransformError as e:
+            return e.message, e.status, e.headers
+        if response is not None:
+            return response
+
+    return serve_derivative(*resized_image_job(image_url, width, height))
+
+
+def resized_image_job(image_url, width, height):
+    key = TransformKey(image_url, width, height, 'original', None, resample_key('default'))
+    return key, lambda: render_resized_image(key)
+
+
+def render_resized_image(key):
     try:
-        response = requests.get(remote_url + uri, stream=True)
-        response.raise_for_status()  # Raise an exception for non-200 status codes
-        content_type = response.headers.get('content-type', '')
-        if not (content_type.startswith('image/jpeg') or content_type.startswith('image/png') or content_type.startswith('image/webp')):
-            return send_file(BytesIO(response.content), mimetype=content_type)
+        origin = fetch_origin(key.url, ('image/jpeg', 'image/png', 'image/webp'), stream_others=True,
+                              passthrough_size=(key.width, key.height))
     except requests.exceptions.RequestException as e:
-        return 'Error retrieving image: ' + str(e), 500
+        raise TransformError('Error retrieving image: ' + str(e), 500)
+    if origin.status >= 400:
+        raise TransformError(f'Error retrieving image: {origin.status} Error for url: {key.url}', 500)
+    return process_or_reuse(key, origin, process_resized_image, key.width, key.height)
+
+
+def process_resized_image(content_type, data, width, height):
+    # Check if the file format is JPEG, PNG, or WEBP
+    if not (content_type.startswith('image/jpeg') or content_type.startswith('image/png') or content_type.startswith('image/webp')):
+        return passthrough(data, content_type, False)
 
     # Open the downloaded image with PIL
     try:
-        with Image.open(BytesIO(response.content)) as img:
-            # Calculate the new width and height based on the aspect ratio of the original image
-            img_width, img_height = img.size
-            if width == 0:
-                new_width = int(img_width * height / img_height)
-                new_height = height
-            elif height == 0:
-                new_width = width
-                new_height = int(img_height * width / img_width)
-            else:
-                new_width = width
-                new_height = height
+        with Image.open(BytesIO(data)) as img:
+            if width == 0 and height == 0:
+                # Return the original file if both width and height are 0
+                return passthrough(data, content_type, True)
+            new_width, new_height = resized_size(img.size, width, height)
 
-            # Resize the image to the requested dimensions
-            img = img.resize((new_width, new_height))
+            # Return the original file if it already has the requested dimensions
+            if (new_width, new_height) == img.size:
+                return passthrough(data, content_type, True)
 
-            # Serve the resized image
-            img_io = BytesIO()
-            if content_type.startswith('image/jpeg'):
-                img.save(img_io, 'JPEG')
-            elif content_type.startswith('image/png'):
-                img.save(img_io, 'PNG')
-            elif content_type.startswith('image/webp'):
-                img.save(img_io, 'WEBP')
-            else:
-                return send_file(BytesIO(response.content), mimetype=content_type)
-            img_io.seek(0)
-            return send_file(img_io, mimetype=content_type)
+        # Resize the image to the requested dimensions in the worker pool
+        if content_type.startswith('image/jpeg'):
+            image_format = 'JPEG'
+        elif content_type.startswith('image/png'):
+            image_format = 'PNG'
+        else:
+            image_format = 'WEBP'
+        resized = run_transform(data, (new_width, new_height), None, image_format, {})
+        return Derivative(resized, content_type, True)
     except OSError as e:
-        return 'Error processing image: ' + str(e), 500
+        raise TransformError('Error processing image: ' + str(e), 500)
     except ValueError as e:
-        return 'Error processing image: ' + str(e), 500
+        raise TransformError('Error processing image: ' + str(e), 500)
+
+
+def resized_size(size, width, height):
+    # Calculate the new width and height based on the aspect ratio of the original image
+    img_width, img_height = size
+    if width == 0:
+        return int(img_width * height / img_height), height
+    if height == 0:
+        return width, int(img_height * width / img_width)
+    return width, height
+
 
 @app.route('/webp/<path:url>')
 def convert_to_webp(url):
-    # Parse the remote URL and URI from the request
-    match = re.match(r'(https?://[^/]+)(/.*)', url)
-    if not match:
-        return 'Invalid URL', 400
-    remote_url, uri = match.groups()
+    try:
+        image_url = parse_image_url(url)
+    except TransformError as e:
+        return e.message, e.status, e.headers
 
-    # Check if the remote URL domain is in the allowed domains list
-    if not any(domain in remote_url for domain in allowed_domains):
-        return 'Access denied', 403
+    return serve_derivative(*webp_job(image_url))
 
+
+def webp_job(image_url):
+    key = TransformKey(image_url, 0, 0, 'webp', None, None)
+    return key, lambda: render_webp(key)
+
+
+def render_webp(key):
     # Download the image from the remote URL
-    response = requests.get(remote_url + uri)
+    try:
+        origin = fetch_origin(key.url, ('image/jpeg', 'image/png'), stream_others=True)
+    except requests.exceptions.RequestException:
+        raise TransformError('Failed to download image', 500)
 
     # Check if the response was successful
-    if response.status_code != 200:
-        return 'Failed to download image', 500
+    if origin.status != 200:
+        raise TransformError('Failed to download image', 500)
+    return process_or_reuse(key, origin, process_webp)
+
 
+def process_webp(content_type, data):
     # Check if the file format is JPEG or PNG
-    content_type = response.headers.get('content-type', '')
     if not content_type.startswith('image/jpeg') and not content_type.startswith('image/png'):
-        return send_file(BytesIO(response.content), mimetype=content_type)
+        return passthrough(data, content_type, False)
 
     # Open the downloaded image with Pillow
     try:
-        img = Image.open(BytesIO(response.content))
+        Image.open(BytesIO(data))
     except:
-        return 'Failed to open image', 500
+        raise TransformError('Failed to open image', 500)
 
-    # Convert the image to WebP format
-    webp_img = BytesIO()
+    # Convert the image to WebP format in the worker pool
     try:
-        img.save(webp_img, 'webp')
+        webp_data = run_transform(data, None, None, 'webp', {})
+    except TransformError:
+        raise
     except:
-        return 'Failed to convert image to WebP', 500
-    webp_img.seek(0)
+        raise TransformError('Failed to convert image to WebP', 500)
 
     # Serve the converted image
-    return send_file(webp_img, mimetype='image/webp')
+    return Derivative(webp_data, 'image/webp', True)
 
 @app.route('/webp/<int:width>x<int:height>/<path:url>')
 def resize_and_convert_to_webp(width, height, url):
-    # Extract the remote URL and URI from the request URL
-    match = re.match(r'(https?://[^/]+)(/.*)', url)
-    if not match:
-        return 'Invalid URL', 400
-    remote_url, uri = match.groups()
+    try:
+        image_url = parse_image_url(url)
+    except TransformError as e:
+        return e.message, e.status, e.headers
+
+    # Snap the requested size to its bucket
+    bucket_width, bucket_height = size_buckets.snap_size(width, height)
+    if (bucket_width, bucket_height) != (width, height):
+        if bucket_mode == 'redirect':
+            return redirect(bucketed_path(request.full_path.rstrip('?'), width, height, bucket_width, bucket_height))
+        width, height = bucket_width, bucket_height
+
+    # The original is sent unchanged, so stream it instead of downloading it first
+    if width == 0 and height == 0:
+        try:
+            response = stream_origin(image_url)
+        except TransformError as e:
+            return e.message, e.status, e.headers
+        if response is not None:
+            return response
+
+    return serve_derivative(*resized_webp_job(image_url, width, height))
+
 
-    # Check if the remote URL domain is in the allowed domains list
-    if not any(domain in remote_url for domain in allowed_domains):
-        return 'Access denied', 403
+def resized_webp_job(image_url, width, height):
+    key = TransformKey(image_url, width, height, 'webp', 85, resample_key('lanczos'))
+    return key, lambda: render_resized_webp(key)
 
+
+def render_resized_webp(key):
     # Download the image from the remote URL
     try:
-        response = requests.get(remote_url + uri)
+        origin = fetch_origin(key.url, ('image/jpeg', 'image/png'), stream_others=True)
     except requests.exceptions.RequestException as e:
-        return f'Error: {e}', 500
+        raise TransformError(f'Error: {e}', 500)
+    return process_or_reuse(key, origin, process_resized_webp, key.width, key.height)
+
+
+@app.route('/webp/srcset/<widths>/<path:url>')
+def resize_and_convert_to_webp_set(widths, url):
+    # Render several widths of one image with a single download and decode, e.g.
+    # /webp/srcset/320,640,960,1280/<url>. Each width is stored under the same key as
+    # /webp/<w>x0/ and returned as a multipart/mixed part in the order requested,
+    # with X-Batch-Index and X-Width telling the parts apart.
+    try:
+        widths = [int(width) for width in widths.split(',')]
+    except ValueError:
+        return 'Invalid input', 400
+    if not 0 < len(widths) <= batch_max_jobs or min(widths) <= 0:
+        return 'Invalid input', 400
+
+    try:
+        image_url = parse_image_url(url)
+    except TransformError as e:
+        return e.message, e.status, e.headers
+
+    # Widths that snap to the same bucket are rendered once
+    sizes = [size_buckets.snap_size(width, 0) for width in widths]
+    unique_sizes = list(dict.fromkeys(sizes))
+    try:
+        results = dict(zip(unique_sizes, get_derivative_set(image_url, unique_sizes)))
+    except TransformError as e:
+        return e.message, e.status, e.headers
+
+    boundary = uuid.uuid4().hex
+    body = b''
+    for index, size in enumerate(sizes):
+        headers, data = batch_derivative_part(index, *results[size])
+        headers['X-Width'] = str(size[0])
+        body += multipart_part(boundary, headers, data)
+    body += f'--{boundary}--\r\n'.encode('utf-8')
+    return Response(body, mimetype=f'multipart/mixed; boundary={boundary}', headers={'Cache-Control': 'no-store'})
+
+
+def get_derivative_set(image_url, sizes):
+    # Like get_derivative for several sizes of /webp/<w>x<h>/: cached sizes are served from
+    # the cache, and all missing ones are rendered together. Returns (key, derivative, cache status).
+    # Stale sizes are served as they are while the origin is revalidated in the background;
+    # the next request renders the set again if the image changed.
+    direct_keys = [resized_webp_job(image_url, width, height)[0] for width, height in sizes]
+    keys = list(direct_keys)
+    results = [lookup_derivative(key, serve_stale=True) for key in keys]
+    for i, (derivative, _) in enumerate(results):
+        if derivative is None:
+            keys[i] = chained_key(direct_keys[i])
+            results[i] = lookup_derivative(keys[i], serve_stale=True)
+    if any(cache_status == 'STALE' for _, cache_status in results):
+        refresher.submit(('origin', image_url), lambda: fetch_origin(image_url))
+    missing = [i for i, (derivative, _) in enumerate(results) if derivative is None]
+    if missing:
+        # The largest missing size is rendered straight from the decoded image like
+        # /webp/<w>x<h>/, so it is stored under the same key
+        largest = max(missing, key=lambda i: sizes[i][0])
+        keys[largest] = direct_keys[largest]
+
+        def render_and_store():
+            derivatives = render_resized_webp_set(image_url, [sizes[i] for i in missing])
+            for i, derivative in zip(missing, derivatives):
+                store_derivative(keys[i], derivative)
+            return derivatives
+
+        derivatives, shared = render_flight.do(tuple(keys[i] for i in missing), render_and_store)
+        for i, derivative in zip(missing, derivatives):
+            results[i] = (derivative, 'COALESCED' if shared else 'MISS')
+    return [(key, derivative, cache_status) for key, (derivative, cache_status) in zip(keys, results)]
 
+
+def chained_key(key):
+    # Smaller sizes of a set are downscaled from the next larger one, which gives slightly
+    # different bytes than a direct render, so they are cached and validated separately
+    return key._replace(resample=key.resample + '+chain')
+
+
+def render_resized_webp_set(image_url, sizes):
+    # Download the image from the remote URL
+    try:
+        origin = fetch_origin(image_url, ('image/jpeg', 'image/png'))
+    except requests.exceptions.RequestException as e:
+        raise TransformError(f'Error: {e}', 500)
+    derivatives = process_resized_webp_set(origin.content_type, origin.data, sizes)
+    return [derivative._replace(source=origin.version) for derivative in derivatives]
+
+
+def process_resized_webp(content_type, data, width, height):
+    return process_resized_webp_set(content_type, data, [(width, height)])[0]
+
+
+def process_resized_webp_set(content_type, data, sizes):
     # Check if the file format is JPEG, PNG, or WebP
-    content_type = response.headers.get('content-type', '')
     if not content_type.startswith(('image/jpeg', 'image/png', 'image/webp')):
         # Return the original file if it's not JPEG, PNG, or WebP
-        return send_file(BytesIO(response.content), mimetype=content_type)
+        return [passthrough(data, content_type, False) for _ in sizes]
 
     # Open the downloaded image with Pillow
     try:
-        img = Image.open(BytesIO(response.content))
+        img = Image.open(BytesIO(data))
     except OSError as e:
-        return f'Error: {e}', 500
+        raise TransformError(f'Error: {e}', 500)
 
     # If the image format is already WebP, return it as-is
     if content_type == 'image/webp':
-        return send_file(BytesIO(response.content), mimetype=content_type)
+        return [passthrough(data, content_type, True) for _ in sizes]
 
-    # Calculate the new width and height based on the aspect ratio of the original image
+    # Calculate the new width and height of every size based on the aspect ratio of the original image
     orig_width, orig_height = img.size
-    if width == 0 and height == 0:
-        # Return the original file if both width and height are 0
-        return send_file(BytesIO(response.content), mimetype=content_type)
-    elif width == 0:
-        new_width = int(orig_width * height / orig_height)
-        new_height = height
-    elif height == 0:
-        new_width = width
-        new_height = int(orig_height * width / orig_width)
+    derivatives = [None] * len(sizes)
+    resized = {}
+    for i, (width, height) in enumerate(sizes):
+        if width == 0 and height == 0:
+            # Return the original file if both width and height are 0
+            derivatives[i] = passthrough(data, content_type, True)
+        elif width == 0:
+            resized[i] = (int(orig_width * height / orig_height), height)
+        elif height == 0:
+            resized[i] = (width, int(orig_height * width / orig_width))
+        else:
+            resized[i] = (width, height)
+
+    # Resize and convert the image to WebP format in the worker pool, decoding it only once
+    if resized:
+        try:
+            webp_data = run_transform_sizes(data, list(resized.values()), Image.LANCZOS, 'webp', {'quality': 85})
+        except OSError as e:
+            raise TransformError(f'Error: {e}', 500)
+        except ValueError as e:
+            raise TransformError(f'Error: {e}', 500)
+        for i, encoded in zip(resized, webp_data):
+            derivatives[i] = Derivative(encoded, 'image/webp', True)
+
+    # Serve the converted images
+    return derivatives
+
+def accepts_webp(accept_header):
+    # Only an explicit image/webp counts, since browsers without WebP support also send */*
+    accept = parse_accept_header(accept_header, MIMEAccept)
+    return any(value == 'image/webp' and quality > 0 for value, quality in accept)
+
+
+@app.route('/auto/<path:url>')
+def auto_format(url):
+    return auto_format_resized(0, 0, url)
+
+
+@app.route('/auto/<int:width>x<int:height>/<path:url>')
+def auto_format_resized(width, height, url):
+    # Serve WebP to clients that accept it, otherwise the source format
+    if not accepts_webp(request.headers.get('Accept')):
+        response = make_response(resize_image(width, height, url))
+    elif width == 0 and height == 0:
+        response = make_response(convert_to_webp(url))
     else:
-        new_width = width
-        new_height = height
+        response = make_response(resize_and_convert_to_webp(width, height, url))
+
+    # Let shared caches keep the WebP and source format variants apart
+    response.vary.add('Accept')
+    return response
+
+def parse_batch_job(job):
+    # Validate one batch job and return its format, origin URL and bucketed size.
+    # format 'webp' matches /webp/ (or /webp/<w>x<h>/ when a size is given), 'original' matches /<w>x<h>/.
+    if not isinstance(job, dict) or not isinstance(job.get('url'), str):
+        raise TransformError('Invalid job', 400)
+    try:
+        width, height = int(job.get('width', 0)), int(job.get('height', 0))
+    except (TypeError, ValueError):
+        raise TransformError('Invalid input', 400)
+    if width < 0 or height < 0:
+        raise TransformError('Invalid input', 400)
+    image_format = job.get('format', 'webp')
+    if image_format not in ('webp', 'original'):
+        raise TransformError('Invalid format', 400)
 
-    # Resize the image to the requested dimensions
-    img = img.resize((new_width, new_height), resample=Image.LANCZOS)
+    image_url = parse_image_url(job['url'])
+    width, height = size_buckets.snap_size(width, height)
+    return image_format, image_url, width, height
 
-    # Convert the image to WebP format
-    webp_img = BytesIO()
-    img.save(webp_img, 'webp', quality=85)
-    webp_img.seek(0)
 
-    # Serve the converted image
-    return send_file(webp_img, mimetype='image/webp')
+def batch_job(job):
+    # The transform key and render function of one batch job, as its route would build them
+    image_format, image_url, width, height = parse_batch_job(job)
+    if image_format == 'original':
+        return resized_image_job(image_url, width, height)
+    if width == 0 and height == 0:
+        return webp_job(image_url)
+    return resized_webp_job(image_url, width, height)
+
+
+def batch_part(index, job):
+    # Run one batch job and return its multipart headers and body; failures become a part too
+    try:
+        key, render = batch_job(job)
+        try:
+            derivative, cache_status = get_derivative(key, render)
+        except PassthroughRequired:
+            # Bodies the routes would stream are sent unchanged
+            derivative, cache_status = download_passthrough(key.url), 'MISS'
+    except TransformError as e:
+        return batch_error_part(index, e)
+    except Exception:
+        # Any other failure still gets a part, so the remaining jobs are sent
+        app.logger.exception('Batch job %d failed', index)
+        return batch_error_part(index, TransformError('Image processing failed', 500))
+    return batch_derivative_part(index, key, derivative, cache_status)
+
+
+def batch_error_part(index, error):
+    return {'Content-Type': 'text/plain; charset=utf-8', 'X-Batch-Index': str(index), 'X-Batch-Status': str(error.status)}, error.message.encode('utf-8')
+
+
+def batch_derivative_part(index, key, derivative, cache_status):
+    metrics.inc('converter_cache_total', (('result', cache_status),))
+    metrics.inc('converter_response_bytes_total', value=len(derivative.data))
+    headers = {'Content-Type': derivative.mimetype, 'X-Batch-Index': str(index), 'X-Batch-Status': '200', 'X-Cache': cache_status}
+    if derivative.cacheable:
+        headers['ETag'] = quote_etag(derivative_etag(key, derivative))
+    return headers, derivative.data
+
+
+def multipart_part(boundary, headers, body):
+    head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    return f'--{boundary}\r\n{head}Content-Length: {len(body)}\r\n\r\n'.encode('utf-8') + body + b'\r\n'
+
+
+def parse_batch(body):
+    # A batch is a JSON list of jobs, or an object with a "jobs" list
+    try:
+        jobs = json.loads(body)
+    except ValueError:
+        raise TransformError('Invalid batch', 400)
+    if isinstance(jobs, dict):
+        jobs = jobs.get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        raise TransformError('Invalid batch', 400)
+    if len(jobs) > batch_max_jobs:
+        raise TransformError(f'Too many jobs, at most {batch_max_jobs} per batch', 413)
+    return jobs
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    # Run up to batch_concurrency jobs at a time and stream each result as a multipart/mixed
+    # part as soon as it is ready. X-Batch-Index refers to the position in the request.
+    try:
+        jobs = parse_batch(request.get_data())
+    except TransformError as e:
+        return e.message, e.status, e.headers
+    boundary = uuid.uuid4().hex
+
+    def generate():
+        pending = list(enumerate(jobs))
+        running = set()
+        while pending or running:
+            while pending and len(running) < batch_concurrency:
+                running.add(batch_executor.submit(batch_part, *pending.pop(0)))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield multipart_part(boundary, *future.result())
+        yield f'--{boundary}--\r\n'.encode('utf-8')
+
+    return Response(generate(), mimetype=f'multipart/mixed; boundary={boundary}', headers={'Cache-Control': 'no-store'})
+
+
+@app.route('/peer/derivative', methods=['POST'])
+def peer_derivative():
+    # Render a job forwarded by another node. Jobs are never forwarded again from here, so
+    # nodes with different peer lists cannot send a key around in a loop.
+    try:
+        key, render = batch_job(request.get_json(force=True, silent=True))
+        derivative, cache_status = get_derivative(key, render, forward=False)
+    except PassthroughRequired as e:
+        return e.message, e.status, {'X-Passthrough': '1'}
+    except TransformError as e:
+        return e.message, e.status, e.headers
+    return Response(derivative.data, mimetype=derivative.mimetype, headers=peer_derivative_headers(derivative, cache_status))
+
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001, threaded=True)
     #app.run(port=5001, threaded=True)
-
-
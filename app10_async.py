@@ -0,0 +1,616 @@
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import asyncio
+import uuid
+from urllib.parse import urlsplit
+
+import app10
+from app10 import accepts_webp, config, metrics, OriginBody, PassthroughRequired, StageTimer, TransformError, TransformKey, parse_image_url, resample_key
+
+# Read async server settings from config file. Threads only run cache I/O and wait on
+# the worker process pool; origin downloads never hold a thread.
+async_port = config.getint('async', 'port', fallback=5002)
+async_threads = config.getint('async', 'threads', fallback=32)
+async_origin_connections = config.getint('async', 'origin_connections', fallback=1000)
+
+
+class AsyncSingleFlight:
+    # Concurrent calls with the same key on the event loop share one execution of the coroutine
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.calls = {}
+
+    async def do(self, key, fn):
+        # Return the result and whether it was shared from another caller
+        future = self.calls.get(key)
+        if future is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout), True
+            except asyncio.TimeoutError:
+                raise TransformError('Timed out waiting for image', 504)
+
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # The leading client went away; let the followers fail instead of waiting
+            future.set_exception(TransformError('Image request was cancelled', 503))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.calls[key]
+        return result, False
+
+
+render_flight = AsyncSingleFlight(app10.coalesce_timeout)
+peer_flight = AsyncSingleFlight(app10.coalesce_timeout)
+
+# Background refreshes of derivatives served stale, at most one per key
+refresh_tasks = {}
+
+
+def run_blocking(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def fetch_origin(request, image_url, probe_types=(), stream_others=False, passthrough_size=None):
+    # Download without blocking the event loop, under the same limits as app10.read_origin_body.
+    # Goes through app10.origin_store and app10.origin_breaker like app10.fetch_origin and
+    # returns an OriginEntry.
+    origin_store = app10.origin_store
+    entry, fresh = origin_store.lookup(image_url)
+    if fresh:
+        metrics.inc('converter_origin_requests_total', (('result', 'fresh'),))
+        return entry
+
+    async def request_origin():
+        timeout = aiohttp.ClientTimeout(sock_connect=app10.origin_connect_timeout, sock_read=app10.origin_read_timeout)
+        with StageTimer('fetch'):
+            async with request.app['origin_session'].get(image_url, timeout=timeout, headers=origin_store.conditional_headers(entry)) as response:
+                if response.status == 304 and entry is not None:
+                    metrics.inc('converter_origin_requests_total', (('result', 'not_modified'),))
+                    return origin_store.refresh(image_url, entry, response.headers)
+                content_type = response.headers.get('content-type', '')
+                if stream_others and response.status == 200 and not content_type.startswith(probe_types):
+                    raise PassthroughRequired()
+                body = OriginBody(content_type, response.headers.get('content-length'), probe_types, passthrough_size)
+                async for chunk in response.content.iter_chunked(app10.origin_chunk_size):
+                    body.feed(chunk)
+        metrics.inc('converter_origin_requests_total', (('result', 'fetched'),))
+        return origin_store.store(image_url, response.status, response.headers, content_type, body.getvalue())
+
+    host = urlsplit(image_url).netloc
+    app10.origin_breaker.before(host)
+    try:
+        result = await request_origin()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        app10.origin_breaker.failure(host)
+        raise
+    except asyncio.CancelledError:
+        app10.origin_breaker.cancel(host)
+        raise
+    except BaseException:
+        app10.origin_breaker.success(host)
+        raise
+    if result.status >= 500:
+        app10.origin_breaker.failure(host)
+    else:
+        app10.origin_breaker.success(host)
+    return result
+
+
+async def known_source(request, url, serve_stale=False):
+    # Same as app10.known_source, but a stale origin entry is revalidated with the
+    # non-blocking fetch_origin instead of holding an executor thread
+    entry, fresh = app10.origin_store.lookup(url)
+    if entry is not None and not fresh:
+        if serve_stale and app10.origin_store.serves_stale(entry):
+            return entry.version, True
+        try:
+            result = await fetch_origin(request, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, TransformError):
+            result = None
+        entry = app10.revalidated_entry(entry, result)
+        if entry is None:
+            return None, False
+    return await run_blocking(app10.indexed_source, url, entry, serve_stale)
+
+
+async def lookup_derivative(request, key, serve_stale=False):
+    source, stale = await known_source(request, key.url, serve_stale)
+    return await run_blocking(app10.source_derivative, key, source, stale)
+
+
+async def download_passthrough(request, image_url):
+    # Same as app10.download_passthrough
+    try:
+        origin = await fetch_origin(request, image_url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise TransformError('Error retrieving image: ' + str(e), 500)
+    if origin.status != 200:
+        raise TransformError('Failed to download image', 500)
+    return app10.passthrough(origin.data, origin.content_type, False)
+
+
+async def get_derivative(request, key, render, forward=True, serve_stale=True):
+    # Same flow as app10.get_derivative, with the render awaited on the event loop
+    error = app10.failed_renders.get(key)
+    if error is not None:
+        raise type(error)(error.message, error.status, error.headers)
+
+    derivative, cache_status = await lookup_derivative(request, key, serve_stale)
+    if cache_status == 'STALE':
+        if key not in refresh_tasks:
+            refresh_tasks[key] = asyncio.ensure_future(refresh_derivative(request, key, render, forward))
+        return derivative, cache_status
+    owner = app10.peer_owner(key) if derivative is None and forward else None
+    if owner is not None:
+        derivative, shared = await peer_flight.do(key, lambda: forward_derivative(request, owner, key))
+        if derivative is not None:
+            return derivative, 'COALESCED' if shared else 'PEER'
+    if derivative is None:
+        async def render_and_store():
+            try:
+                derivative = await render()
+            except TransformError as e:
+                app10.remember_failure(key, e)
+                raise
+            await run_blocking(app10.store_derivative, key, derivative)
+            return derivative
+
+        derivative, shared = await render_flight.do(key, render_and_store)
+        if shared:
+            cache_status = 'COALESCED'
+    return derivative, cache_status
+
+
+async def refresh_derivative(request, key, render, forward):
+    # Same as app10.refresh_derivative, as a task on the event loop
+    try:
+        await fetch_origin(request, key.url)
+        await get_derivative(request, key, render, forward, serve_stale=False)
+        metrics.inc('converter_refresh_total', (('result', 'refreshed'),))
+    except Exception:
+        metrics.inc('converter_refresh_total', (('result', 'failed'),))
+    finally:
+        del refresh_tasks[key]
+
+
+async def refresh_origin(request, image_url):
+    # Revalidate the origin of a srcset served stale, as a task on the event loop
+    try:
+        await fetch_origin(request, image_url)
+        metrics.inc('converter_refresh_total', (('result', 'refreshed'),))
+    except Exception:
+        metrics.inc('converter_refresh_total', (('result', 'failed'),))
+    finally:
+        del refresh_tasks[('origin', image_url)]
+
+
+async def forward_derivative(request, owner, key):
+    # Same as app10.forward_derivative, without holding a thread while the owner renders
+    try:
+        app10.peer_breaker.before(owner)
+    except TransformError:
+        metrics.inc('converter_peer_total', (('result', 'fallback'),))
+        return None
+    timeout = aiohttp.ClientTimeout(sock_connect=app10.peer_connect_timeout, sock_read=app10.peer_read_timeout)
+    try:
+        with StageTimer('peer'):
+            async with request.app['origin_session'].post(owner + '/peer/derivative', json=app10.peer_job(key), timeout=timeout) as response:
+                status, headers, body = response.status, response.headers, await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        app10.peer_breaker.failure(owner)
+        metrics.inc('converter_peer_total', (('result', 'fallback'),))
+        return None
+    except asyncio.CancelledError:
+        app10.peer_breaker.cancel(owner)
+        raise
+    app10.peer_breaker.success(owner)
+    metrics.inc('converter_peer_total', (('result', 'forwarded'),))
+    return app10.peer_response(status, headers, body)
+
+
+async def stream_origin(request, image_url):
+    # Same as app10.stream_origin: send the origin body unchanged as it arrives
+    entry, fresh = app10.origin_store.lookup(image_url)
+    if fresh:
+        if entry.status != 200:
+            return None
+        headers = app10.stored_passthrough_headers(entry)
+        if app10.passthrough_not_modified(entry, request.headers):
+            return web.Response(status=304, headers=headers)
+        metrics.inc('converter_passthrough_total')
+        metrics.inc('converter_response_bytes_total', value=len(entry.data))
+        return web.Response(body=entry.data, headers=headers)
+
+    host = urlsplit(image_url).netloc
+    app10.origin_breaker.before(host)
+    timeout = aiohttp.ClientTimeout(sock_connect=app10.origin_connect_timeout, sock_read=app10.origin_read_timeout)
+    try:
+        async with request.app['passthrough_session'].get(image_url, timeout=timeout,
+                                                          headers=app10.passthrough_request_headers(request.headers)) as origin:
+            if origin.status >= 500:
+                app10.origin_breaker.failure(host)
+            else:
+                app10.origin_breaker.success(host)
+            headers = app10.origin_response_headers(origin.headers)
+            headers['X-Cache'] = 'STREAM'
+            if origin.status == 304:
+                return web.Response(status=304, headers=headers)
+            if origin.status != 200:
+                return None
+            metrics.inc('converter_passthrough_total')
+            metrics.inc('converter_origin_content_types_total', (('content_type', headers.get('Content-Type', '').split(';')[0].strip()),))
+
+            response = web.StreamResponse(headers=headers)
+            await response.prepare(request)
+            kept, size = [], 0
+            try:
+                async for chunk in origin.content.iter_chunked(app10.origin_chunk_size):
+                    size += len(chunk)
+                    if kept is not None and size <= app10.passthrough_cache_bytes:
+                        kept.append(chunk)
+                    else:
+                        kept = None
+                    await response.write(chunk)
+            finally:
+                metrics.inc('converter_origin_bytes_total', value=size)
+                metrics.inc('converter_response_bytes_total', value=size)
+            await response.write_eof()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        app10.origin_breaker.failure(host)
+        raise TransformError('Error retrieving image: ' + str(e), 500)
+    except asyncio.CancelledError:
+        # The client went away, possibly while this request was the breaker's probe
+        app10.origin_breaker.cancel(host)
+        raise
+    if kept is not None and 'Content-Encoding' not in headers:
+        app10.origin_store.store(image_url, 200, origin.headers, headers.get('Content-Type', ''), b''.join(kept))
+    return response
+
+
+async def serve_derivative(request, key, render):
+    # Same flow as app10.serve_derivative, with the render awaited on the event loop
+    etag = app10.known_etag(key)
+    if app10.etag_matches(request.headers.get('If-None-Match'), etag):
+        metrics.inc('converter_cache_total', (('result', 'NOT-MODIFIED'),))
+        return web.Response(status=304, headers=app10.caching_headers(etag))
+
+    try:
+        derivative, cache_status = await get_derivative(request, key, render)
+    except PassthroughRequired:
+        try:
+            return await stream_origin(request, key.url) or web.Response(text='Failed to download image', status=500)
+        except TransformError as e:
+            return web.Response(text=e.message, status=e.status, headers=e.headers)
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+
+    etag = app10.derivative_etag(key, derivative) if derivative.cacheable else None
+    if app10.etag_matches(request.headers.get('If-None-Match'), etag):
+        metrics.inc('converter_cache_total', (('result', 'NOT-MODIFIED'),))
+        return web.Response(status=304, headers=app10.caching_headers(etag))
+
+    metrics.inc('converter_cache_total', (('result', cache_status),))
+    metrics.inc('converter_response_bytes_total', value=len(derivative.data))
+    headers = app10.caching_headers(etag)
+    headers.update({'Content-Type': derivative.mimetype, 'X-Cache': cache_status})
+    return web.Response(body=derivative.data, headers=headers)
+
+
+@web.middleware
+async def count_responses(request, handler):
+    response = await handler(request)
+    metrics.inc('converter_responses_total', (('status', str(response.status)),))
+    return response
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+async def resize_image(request):
+    width, height = int(request.match_info.get('width', 0)), int(request.match_info.get('height', 0))
+
+    # Validate input values
+    if width < 0 or height < 0:
+        return web.Response(text='Invalid input', status=400)
+
+    try:
+        image_url = parse_image_url(request.match_info['url'])
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+
+    # Snap the requested size to its bucket
+    bucket_width, bucket_height = app10.size_buckets.snap_size(width, height)
+    if (bucket_width, bucket_height) != (width, height):
+        if app10.bucket_mode == 'redirect':
+            location = app10.bucketed_path(request.path_qs, width, height, bucket_width, bucket_height)
+            return web.Response(status=302, headers={'Location': location})
+        width, height = bucket_width, bucket_height
+
+    # The original is sent unchanged, so stream it instead of downloading it first
+    if width == 0 and height == 0:
+        try:
+            response = await stream_origin(request, image_url)
+        except TransformError as e:
+            return web.Response(text=e.message, status=e.status, headers=e.headers)
+        if response is not None:
+            return response
+
+    return await serve_derivative(request, *resized_image_job(request, image_url, width, height))
+
+
+def resized_image_job(request, image_url, width, height):
+    async def render():
+        try:
+            origin = await fetch_origin(request, image_url, ('image/jpeg', 'image/png', 'image/webp'), stream_others=True,
+                                        passthrough_size=(width, height))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransformError('Error retrieving image: ' + str(e), 500)
+        if origin.status >= 400:
+            raise TransformError(f'Error retrieving image: {origin.status} Error for url: {image_url}', 500)
+        return await run_blocking(app10.process_or_reuse, key, origin, app10.process_resized_image, width, height)
+
+    key = TransformKey(image_url, width, height, 'original', None, resample_key('default'))
+    return key, render
+
+
+async def convert_to_webp(request):
+    try:
+        image_url = parse_image_url(request.match_info['url'])
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+
+    return await serve_derivative(request, *webp_job(request, image_url))
+
+
+def webp_job(request, image_url):
+    async def render():
+        try:
+            origin = await fetch_origin(request, image_url, ('image/jpeg', 'image/png'), stream_others=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise TransformError('Failed to download image', 500)
+        if origin.status != 200:
+            raise TransformError('Failed to download image', 500)
+        return await run_blocking(app10.process_or_reuse, key, origin, app10.process_webp)
+
+    key = TransformKey(image_url, 0, 0, 'webp', None, None)
+    return key, render
+
+
+async def resize_and_convert_to_webp(request):
+    width, height = int(request.match_info.get('width', 0)), int(request.match_info.get('height', 0))
+
+    try:
+        image_url = parse_image_url(request.match_info['url'])
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+
+    # Snap the requested size to its bucket
+    bucket_width, bucket_height = app10.size_buckets.snap_size(width, height)
+    if (bucket_width, bucket_height) != (width, height):
+        if app10.bucket_mode == 'redirect':
+            location = app10.bucketed_path(request.path_qs, width, height, bucket_width, bucket_height)
+            return web.Response(status=302, headers={'Location': location})
+        width, height = bucket_width, bucket_height
+
+    # The original is sent unchanged, so stream it instead of downloading it first
+    if width == 0 and height == 0:
+        try:
+            response = await stream_origin(request, image_url)
+        except TransformError as e:
+            return web.Response(text=e.message, status=e.status, headers=e.headers)
+        if response is not None:
+            return response
+
+    return await serve_derivative(request, *resized_webp_job(request, image_url, width, height))
+
+
+def resized_webp_job(request, image_url, width, height):
+    async def render():
+        try:
+            origin = await fetch_origin(request, image_url, ('image/jpeg', 'image/png'), stream_others=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransformError(f'Error: {e}', 500)
+        return await run_blocking(app10.process_or_reuse, key, origin, app10.process_resized_webp, width, height)
+
+    key = TransformKey(image_url, width, height, 'webp', 85, resample_key('lanczos'))
+    return key, render
+
+
+async def resize_and_convert_to_webp_set(request):
+    # Same as app10.resize_and_convert_to_webp_set
+    try:
+        widths = [int(width) for width in request.match_info['widths'].split(',')]
+    except ValueError:
+        return web.Response(text='Invalid input', status=400)
+    if not 0 < len(widths) <= app10.batch_max_jobs or min(widths) <= 0:
+        return web.Response(text='Invalid input', status=400)
+
+    try:
+        image_url = parse_image_url(request.match_info['url'])
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+
+    sizes = [app10.size_buckets.snap_size(width, 0) for width in widths]
+    unique_sizes = list(dict.fromkeys(sizes))
+    try:
+        results = dict(zip(unique_sizes, await get_derivative_set(request, image_url, unique_sizes)))
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+
+    boundary = uuid.uuid4().hex
+    body = b''
+    for index, size in enumerate(sizes):
+        headers, data = app10.batch_derivative_part(index, *results[size])
+        headers['X-Width'] = str(size[0])
+        body += app10.multipart_part(boundary, headers, data)
+    body += f'--{boundary}--\r\n'.encode('utf-8')
+    return web.Response(body=body, headers={'Content-Type': f'multipart/mixed; boundary={boundary}', 'Cache-Control': 'no-store'})
+
+
+async def get_derivative_set(request, image_url, sizes):
+    # Same flow as app10.get_derivative_set, with the download awaited on the event loop
+    direct_keys = [resized_webp_job(request, image_url, width, height)[0] for width, height in sizes]
+    keys = list(direct_keys)
+    results = [await lookup_derivative(request, key, serve_stale=True) for key in keys]
+    for i, (derivative, _) in enumerate(results):
+        if derivative is None:
+            keys[i] = app10.chained_key(direct_keys[i])
+            results[i] = await lookup_derivative(request, keys[i], serve_stale=True)
+    if any(cache_status == 'STALE' for _, cache_status in results) and ('origin', image_url) not in refresh_tasks:
+        refresh_tasks[('origin', image_url)] = asyncio.ensure_future(refresh_origin(request, image_url))
+    missing = [i for i, (derivative, _) in enumerate(results) if derivative is None]
+    if missing:
+        largest = max(missing, key=lambda i: sizes[i][0])
+        keys[largest] = direct_keys[largest]
+
+        async def render_and_store():
+            try:
+                origin = await fetch_origin(request, image_url, ('image/jpeg', 'image/png'))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise TransformError(f'Error: {e}', 500)
+            derivatives = await run_blocking(app10.process_resized_webp_set, origin.content_type, origin.data, [sizes[i] for i in missing])
+            derivatives = [derivative._replace(source=origin.version) for derivative in derivatives]
+            for i, derivative in zip(missing, derivatives):
+                await run_blocking(app10.store_derivative, keys[i], derivative)
+            return derivatives
+
+        derivatives, shared = await render_flight.do(tuple(keys[i] for i in missing), render_and_store)
+        for i, derivative in zip(missing, derivatives):
+            results[i] = (derivative, 'COALESCED' if shared else 'MISS')
+    return [(key, derivative, cache_status) for key, (derivative, cache_status) in zip(keys, results)]
+
+
+async def auto_format(request):
+    # Serve WebP to clients that accept it, otherwise the source format
+    width, height = int(request.match_info.get('width', 0)), int(request.match_info.get('height', 0))
+    if not accepts_webp(request.headers.get('Accept')):
+        return await resize_image(request)
+    if width == 0 and height == 0:
+        return await convert_to_webp(request)
+    return await resize_and_convert_to_webp(request)
+
+
+async def vary_auto_format(request, response):
+    # Let shared caches keep the WebP and source format variants of /auto/ apart. Added when
+    # the response is prepared, since streamed passthroughs send their headers before
+    # auto_format returns.
+    if request.match_info.handler is not auto_format:
+        return
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = 'Accept'
+    elif 'accept' not in {value.strip().lower() for value in vary.split(',')}:
+        response.headers['Vary'] = vary + ', Accept'
+
+
+async def batch_part(request, index, job, semaphore):
+    # Same as app10.batch_part; the semaphore limits how many jobs of one batch run at once
+    async with semaphore:
+        try:
+            key, render = batch_job(request, job)
+            try:
+                derivative, cache_status = await get_derivative(request, key, render)
+            except PassthroughRequired:
+                derivative, cache_status = await download_passthrough(request, key.url), 'MISS'
+        except TransformError as e:
+            return app10.batch_error_part(index, e)
+        except Exception:
+            app10.app.logger.exception('Batch job %d failed', index)
+            return app10.batch_error_part(index, TransformError('Image processing failed', 500))
+    return app10.batch_derivative_part(index, key, derivative, cache_status)
+
+
+def batch_job(request, job):
+    # Same as app10.batch_job
+    image_format, image_url, width, height = app10.parse_batch_job(job)
+    if image_format == 'original':
+        return resized_image_job(request, image_url, width, height)
+    if width == 0 and height == 0:
+        return webp_job(request, image_url)
+    return resized_webp_job(request, image_url, width, height)
+
+
+async def batch(request):
+    # Stream each job's result as a multipart/mixed part as soon as it is ready
+    try:
+        jobs = app10.parse_batch(await request.read())
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+    boundary = uuid.uuid4().hex
+    semaphore = asyncio.Semaphore(app10.batch_concurrency)
+    tasks = [asyncio.ensure_future(batch_part(request, index, job, semaphore)) for index, job in enumerate(jobs)]
+
+    response = web.StreamResponse(headers={'Content-Type': f'multipart/mixed; boundary={boundary}', 'Cache-Control': 'no-store'})
+    try:
+        await response.prepare(request)
+        for task in asyncio.as_completed(tasks):
+            await response.write(app10.multipart_part(boundary, *await task))
+        await response.write(f'--{boundary}--\r\n'.encode('utf-8'))
+    finally:
+        # The client went away; do not keep rendering for it
+        for task in tasks:
+            task.cancel()
+    await response.write_eof()
+    return response
+
+
+async def peer_derivative(request):
+    # Same as app10.peer_derivative: render a job forwarded by another node, never forwarding it again
+    try:
+        try:
+            job = await request.json()
+        except ValueError:
+            job = None
+        key, render = batch_job(request, job)
+        derivative, cache_status = await get_derivative(request, key, render, forward=False)
+    except PassthroughRequired as e:
+        return web.Response(text=e.message, status=e.status, headers={'X-Passthrough': '1'})
+    except TransformError as e:
+        return web.Response(text=e.message, status=e.status, headers=e.headers)
+    headers = app10.peer_derivative_headers(derivative, cache_status)
+    headers['Content-Type'] = derivative.mimetype
+    return web.Response(body=derivative.data, headers=headers)
+
+
+async def origin_session_context(app):
+    # One non-blocking client with keep-alive connections for all origin downloads
+    connector = aiohttp.TCPConnector(limit=async_origin_connections)
+    app['origin_session'] = aiohttp.ClientSession(connector=connector)
+    # Streamed passthroughs forward the body as sent, so it must not be decompressed
+    app['passthrough_session'] = aiohttp.ClientSession(connector=connector, connector_owner=False, auto_decompress=False)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(async_threads))
+    yield
+    await app['passthrough_session'].close()
+    await app['origin_session'].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[count_responses])
+    app.cleanup_ctx.append(origin_session_context)
+    app.on_response_prepare.append(vary_auto_format)
+    # The more specific /webp/srcset/ and /webp/<w>x<h>/ routes must be registered before /webp/
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_post('/batch', batch)
+    app.router.add_post('/peer/derivative', peer_derivative)
+    app.router.add_get(r'/auto/{width:\d+}x{height:\d+}/{url:.+}', auto_format)
+    app.router.add_get(r'/auto/{url:.+}', auto_format)
+    app.router.add_get(r'/webp/srcset/{widths:[\d,]+}/{url:.+}', resize_and_convert_to_webp_set)
+    app.router.add_get(r'/webp/{width:\d+}x{height:\d+}/{url:.+}', resize_and_convert_to_webp)
+    app.router.add_get(r'/webp/{url:.+}', convert_to_webp)
+    app.router.add_get(r'/{width:\d+}x{height:\d+}/{url:.+}', resize_image)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=async_port)
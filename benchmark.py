@@ -0,0 +1,295 @@
+"""Load-test app10.py (or app10_async.py) against a local stand-in origin.
+
+Each route is driven with every image class of a generated corpus, and
+throughput, latency percentiles, server CPU time and peak RSS are written as JSON.
+
+    python benchmark.py --concurrency 16 --requests 200
+    python benchmark.py --server async --warm --output bench_results/async.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+import argparse
+import functools
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Image classes served by the stand-in origin: name -> (format, size)
+IMAGE_CLASSES = {
+    'jpeg-small': ('JPEG', (640, 480)),
+    'jpeg-large': ('JPEG', (4000, 3000)),
+    'png-small': ('PNG', (640, 480)),
+    'png-large': ('PNG', (2000, 1500)),
+    'webp-medium': ('WEBP', (1600, 1200)),
+    'gif-small': ('GIF', (500, 500)),
+}
+
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
+
+# Route templates of the converter; {width} and {url} are filled in per request
+ROUTES = {
+    'resize': '/{width}x0/{url}',
+    'webp': '/webp/{url}',
+    'webp-resize': '/webp/{width}x0/{url}',
+}
+
+SERVER_COMMANDS = {
+    'flask': 'import app10; app10.app.run(port={port}, threaded=True)',
+    'async': 'import app10_async; from aiohttp import web; web.run_app(app10_async.create_app(), port={port})',
+}
+
+
+def generate_corpus(directory):
+    # Deterministic images with enough detail that encoding is not trivially cheap
+    for name, (image_format, size) in IMAGE_CLASSES.items():
+        path = os.path.join(directory, name + EXTENSIONS[image_format])
+        if os.path.exists(path):
+            continue
+        img = Image.merge('RGB', (
+            Image.linear_gradient('L').resize(size),
+            Image.radial_gradient('L').resize(size),
+            Image.effect_noise(size, 48),
+        ))
+        if image_format == 'GIF':
+            img = img.convert('P')
+        img.save(path, image_format)
+
+
+class OriginHandler(SimpleHTTPRequestHandler):
+    extensions_map = {'.jpg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp', '.gif': 'image/gif'}
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_origin(directory):
+    handler = functools.partial(OriginHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start on port {port}')
+
+
+def start_server(kind, port, workdir, warm):
+    # The converter reads config.ini from its working directory
+    cache_limits = '' if warm else 'memory_bytes = 0\ndisk_bytes = 0\n'
+    with open(os.path.join(workdir, 'config.ini'), 'w') as f:
+        f.write('[app]\nallowed_domains = 127.0.0.1\n\n')
+        f.write(f'[cache]\ndisk_dir = {os.path.join(workdir, "cache")}\n{cache_limits}')
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVER_COMMANDS[kind].format(port=port)],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+    return process
+
+
+def process_tree(pid):
+    # The server process and all of its descendants (e.g. worker processes)
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(parents.get(current, []))
+    return tree
+
+
+def cpu_seconds(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except OSError:
+            pass
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def peak_rss(pid):
+    # Sum of VmHWM over the process tree, in bytes
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def reset_peak_rss(pid):
+    # Writing 5 to clear_refs resets VmHWM so each phase reports its own peak
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_phase(base_url, path, count, concurrency):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def one_request(_):
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + path, timeout=120)
+            ok = response.status_code == 200
+            size = len(response.content)
+        except requests.exceptions.RequestException:
+            ok, size = False, 0
+        return time.perf_counter() - start, ok, size
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        samples = list(executor.map(one_request, range(count)))
+    return time.perf_counter() - start, samples
+
+
+def summarize(route, image_class, elapsed, samples, cpu, rss):
+    latencies = sorted(latency * 1000 for latency, ok, _ in samples if ok)
+    errors = sum(1 for _, ok, _ in samples if not ok)
+    return {
+        'route': route,
+        'image_class': image_class,
+        'requests': len(samples),
+        'errors': errors,
+        'elapsed_seconds': round(elapsed, 4),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'mean': statistics.fmean(latencies) if latencies else None,
+            'max': latencies[-1] if latencies else None,
+        },
+        'response_bytes': samples[0][2] if samples else 0,
+        'server_cpu_seconds': round(cpu, 3),
+        'server_peak_rss_bytes': rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image converter against a local origin')
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='flask')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help='requests per route and image class')
+    parser.add_argument('--width', type=int, default=300)
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--classes', default=','.join(IMAGE_CLASSES))
+    parser.add_argument('--warm', action='store_true', help='keep the derivative cache enabled')
+    parser.add_argument('--corpus', help='directory to keep the generated corpus in between runs')
+    parser.add_argument('--output', help='JSON result file (default: bench_results/<timestamp>.json)')
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    output = args.output or os.path.join('bench_results', started.strftime('%Y%m%dT%H%M%SZ') + '.json')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus = args.corpus or os.path.join(workdir, 'corpus')
+        os.makedirs(corpus, exist_ok=True)
+        generate_corpus(corpus)
+        origin = start_origin(corpus)
+        origin_url = f'http://127.0.0.1:{origin.server_address[1]}/'
+
+        port = free_port()
+        server = start_server(args.server, port, workdir, args.warm)
+        base_url = f'http://127.0.0.1:{port}'
+        results = []
+        try:
+            for route in args.routes.split(','):
+                for image_class in args.classes.split(','):
+                    image_format, _ = IMAGE_CLASSES[image_class]
+                    url = origin_url + image_class + EXTENSIONS[image_format]
+                    path = ROUTES[route].format(width=args.width, url=url)
+
+                    reset_peak_rss(server.pid)
+                    cpu_before = cpu_seconds(server.pid)
+                    elapsed, samples = run_phase(base_url, path, args.requests, args.concurrency)
+                    result = summarize(route, image_class, elapsed, samples,
+                                       cpu_seconds(server.pid) - cpu_before, peak_rss(server.pid))
+                    results.append(result)
+                    print(f"{route:12} {image_class:12} {result['throughput_rps']:>9} req/s  "
+                          f"p50 {result['latency_ms']['p50'] or 0:8.1f} ms  p95 {result['latency_ms']['p95'] or 0:8.1f} ms  "
+                          f"p99 {result['latency_ms']['p99'] or 0:8.1f} ms  cpu {result['server_cpu_seconds']:7.2f} s  "
+                          f"rss {result['server_peak_rss_bytes'] / 1048576:7.1f} MiB  errors {result['errors']}")
+        finally:
+            # Stop the worker processes along with the server
+            for pid in reversed(process_tree(server.pid)):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            server.wait()
+            origin.shutdown()
+
+    report = {
+        'started': started.isoformat(),
+        'server': args.server,
+        'concurrency': args.concurrency,
+        'requests_per_phase': args.requests,
+        'width': args.width,
+        'warm_cache': args.warm,
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Check that several processes can share one derivative cache without corrupting it.
+
+Starts a number of processes that write and read the same keys through the disk cache
+backend of app10.py at once, then verifies that no read returned another key's bytes,
+that no temporary files were left behind and, for the SQLite backend, that the recorded
+usage matches the stored entries and stays within the size limit.
+
+Run it from a directory holding a config.ini, like prewarm.py. The cache is created in
+a temporary directory, so the server's cache is not touched.
+
+    python cache_check.py --backend sqlite --processes 6
+    python cache_check.py --backend files --processes 4 --operations 5000
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+import app10
+
+
+def open_cache(backend, path, max_bytes):
+    if backend == 'sqlite':
+        return app10.SQLiteCache(os.path.join(path, 'cache.sqlite3'), max_bytes)
+    return app10.DiskCache(path, max_bytes)
+
+
+def check_key(number):
+    return app10.TransformKey(f'check:{number}', number, 0, 'webp', 85, 'lanczos')
+
+
+def expected_derivative(number):
+    # Bodies of 1 to 64 KiB that can be told apart by key
+    digest = hashlib.sha256(str(number).encode('utf-8')).digest()
+    return app10.Derivative(digest * (32 + number * 37 % 2016), 'image/webp', True, digest.hex())
+
+
+def hammer(backend, path, max_bytes, keys, operations, seed):
+    # Mix writes and reads of random keys; returns the number of reads with wrong content
+    cache = open_cache(backend, path, max_bytes)
+    rng = random.Random(seed)
+    wrong = 0
+    for _ in range(operations):
+        number = rng.randrange(keys)
+        if rng.random() < 0.5:
+            cache.put(check_key(number), expected_derivative(number))
+            continue
+        derivative = cache.get(check_key(number))
+        if derivative is not None and derivative != expected_derivative(number):
+            wrong += 1
+    return wrong
+
+
+def check_sqlite(path, max_bytes):
+    db = sqlite3.connect(os.path.join(path, 'cache.sqlite3'))
+    recorded, = db.execute('SELECT size FROM usage WHERE id = 0').fetchone()
+    stored, count = db.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries').fetchone()
+    db.close()
+    print(f'{count} entries, {stored} bytes stored, {recorded} bytes recorded, limit {max_bytes}')
+    problems = []
+    if recorded != stored:
+        problems.append(f'recorded usage {recorded} differs from stored size {stored}')
+    if stored > max_bytes:
+        problems.append(f'stored size {stored} exceeds the limit {max_bytes}')
+    return problems
+
+
+def check_files(path):
+    names = os.listdir(path)
+    temporary = [name for name in names if name.endswith('.tmp')]
+    print(f'{len(names) - len(temporary)} entries, {len(temporary)} temporary files')
+    return [f'{len(temporary)} temporary files left behind'] if temporary else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a derivative cache backend shared by several processes')
+    parser.add_argument('--backend', choices=('files', 'sqlite'), default=app10.cache_backend)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--operations', type=int, default=2000, help='cache operations per process')
+    parser.add_argument('--keys', type=int, default=200)
+    parser.add_argument('--max-bytes', type=int, default=4 * 1024 * 1024,
+                        help='size limit, small enough that entries are evicted during the run')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        # spawn, like the transform pool, so each process opens the cache on its own
+        with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(hammer, args.backend, path, args.max_bytes, args.keys, args.operations, seed)
+                       for seed in range(args.processes)]
+            wrong = sum(future.result() for future in futures)
+
+        problems = [f'{wrong} reads returned wrong content'] if wrong else []
+        if args.backend == 'sqlite':
+            problems += check_sqlite(path, args.max_bytes)
+        else:
+            problems += check_files(path)
+
+    for problem in problems:
+        print('FAILED: ' + problem, file=sys.stderr)
+    if not problems:
+        print(f'OK: {args.processes} processes, {args.processes * args.operations} operations on the {args.backend} backend')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
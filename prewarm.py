@@ -0,0 +1,152 @@
+"""Render derivatives listed in a manifest into the disk cache of app10.py ahead of traffic.
+
+The manifest has one JSON object per line, either a single job in the format of
+POST /batch or a URL with several variants:
+
+    {"url": "https://example.com/a.jpg", "width": 300}
+    {"url": "https://example.com/b.jpg", "variants": [{"width": 300}, {"width": 600, "format": "original"}]}
+
+Run it from the directory holding the server's config.ini so it uses the same cache.
+Finished jobs are appended to the state file, so an interrupted run resumes where it stopped.
+
+    python prewarm.py manifest.jsonl --concurrency 16
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import app10
+
+
+def read_manifest(path):
+    # Yield every job of the manifest, expanding variants
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print(f'{path}:{number}: invalid JSON, skipped', file=sys.stderr)
+                continue
+            if isinstance(entry, dict) and 'variants' in entry:
+                for variant in entry['variants']:
+                    yield dict(variant, url=entry['url'])
+            else:
+                yield entry
+
+
+def job_id(job):
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return {line.strip() for line in f}
+    except FileNotFoundError:
+        return set()
+
+
+def warm(job):
+    # Render one job through the same pipeline as the server; returns (result, bytes, message)
+    # Cached derivatives are checked against the origin here instead of being served stale
+    # and refreshed in the background, which could finish after the report is printed.
+    # A derivative counts as cached when the origin still has the bytes it was rendered from.
+    try:
+        key, render = app10.batch_job(job)
+        previous, _ = app10.lookup_derivative(key, serve_stale=True)
+        derivative, cache_status = app10.get_derivative(key, render, serve_stale=False)
+    except app10.PassthroughRequired:
+        # The server streams these from the origin, so there is nothing to cache
+        return 'unchanged', 0, None
+    except app10.TransformError as e:
+        return 'failed', 0, f'{e.status} {e.message}'
+    if not derivative.cacheable:
+        return 'failed', 0, f'not cacheable ({derivative.mimetype})'
+    cached = cache_status.startswith('HIT') or (previous is not None and previous.source == derivative.source)
+    return ('cached' if cached else 'rendered'), len(derivative.data), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-render derivatives from a manifest into the disk cache')
+    parser.add_argument('manifest')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--state', help='file recording finished jobs (default: <manifest>.state)')
+    parser.add_argument('--restart', action='store_true', help='ignore the state file and warm every job again')
+    parser.add_argument('--report', help='write the summary as JSON to this file')
+    args = parser.parse_args()
+
+    # Only the disk cache is shared with the server, so do not hold the results in memory
+    app10.derivative_cache.memory = app10.MemoryCache(0)
+
+    state_path = args.state or args.manifest + '.state'
+    done = set() if args.restart else read_state(state_path)
+    if args.restart and os.path.exists(state_path):
+        os.remove(state_path)
+
+    counts = {'rendered': 0, 'cached': 0, 'unchanged': 0, 'failed': 0, 'skipped': 0}
+    total_bytes = 0
+    started = time.perf_counter()
+    last_report = started
+
+    jobs = iter(read_manifest(args.manifest))
+    running = {}
+    with ThreadPoolExecutor(args.concurrency) as executor, open(state_path, 'a') as state:
+        while True:
+            # Keep concurrency jobs in flight, reading the manifest lazily
+            for job in jobs:
+                identifier = job_id(job)
+                if identifier in done:
+                    counts['skipped'] += 1
+                    continue
+                running[executor.submit(warm, job)] = (identifier, job)
+                if len(running) >= args.concurrency:
+                    break
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                identifier, job = running.pop(future)
+                result, size, message = future.result()
+                counts[result] += 1
+                total_bytes += size
+                if message:
+                    print(f"failed {job.get('url') if isinstance(job, dict) else job}: {message}", file=sys.stderr)
+                else:
+                    # Failed jobs are retried on the next run
+                    state.write(identifier + '\n')
+                    state.flush()
+
+            now = time.perf_counter()
+            if now - last_report >= 5:
+                last_report = now
+                processed = counts['rendered'] + counts['cached'] + counts['unchanged'] + counts['failed']
+                print(f'{processed} jobs, {processed / (now - started):.1f} jobs/s, '
+                      f"{counts['rendered']} rendered, {counts['cached']} cached, {counts['failed']} failed")
+
+    elapsed = time.perf_counter() - started
+    processed = counts['rendered'] + counts['cached'] + counts['unchanged'] + counts['failed']
+    report = dict(counts, elapsed_seconds=round(elapsed, 3), bytes=total_bytes,
+                  jobs_per_second=round(processed / elapsed, 2) if elapsed else None)
+    print(f"Done in {elapsed:.1f} s: {counts['rendered']} rendered, {counts['cached']} already cached, "
+          f"{counts['unchanged']} served unchanged, {counts['failed']} failed, "
+          f"{counts['skipped']} skipped from a previous run, "
+          f"{report['jobs_per_second']} jobs/s, {total_bytes / 1048576:.1f} MiB of derivatives")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if app10.transform_pool.executor is not None:
+        app10.transform_pool.executor.shutdown()
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())